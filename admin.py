@@ -15,11 +15,17 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import json
 import os
 import time
 import webapp2
 
 from gfw import common
+from gfw import counts
+from gfw import mailer
+from gfw import outlines
+from gfw import pubsub
+from gfw import seed
 
 import cloudstorage as gcs
 
@@ -33,6 +39,14 @@ my_default_retry_params = gcs.RetryParams(initial_delay=0.2,
 gcs.set_default_retry_params(my_default_retry_params)
 
 
+class JsonHandler(webapp2.RequestHandler):
+    """Base for admin handlers that reply with JSON."""
+
+    def _send_json(self, value):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(value))
+
+
 class BootstrapGcs(webapp2.RequestHandler):
     def get(self):
         """Bootstraps local GCS with test data dwc files in dwc."""
@@ -53,8 +67,106 @@ class BootstrapGcs(webapp2.RequestHandler):
         self.redirect('http://localhost:8000/blobstore')
 
 
+class RefreshAlertCounts(JsonHandler):
+    def get(self):
+        """Refreshes materialized alert counts, run by cron."""
+        table = self.request.get('table')
+        tables = [table] if table else counts.TABLES
+        self._send_json(dict((x, counts.refresh(x)) for x in tables))
+
+
+class RefreshOutlines(JsonHandler):
+    def get(self):
+        """Precomputes country outlines for map thumbnails, run by cron."""
+        iso = self.request.get('iso') or None
+        result = outlines.refresh(iso)
+        self._send_json(dict(countries=len(result)))
+
+
+class SeedTiles(JsonHandler):
+    def start(self):
+        """Starts seeding a layer's tiles over a bbox or country.
+
+        Params: layer, zmin, zmax, bbox=west,south,east,north or iso, and
+        year for the landsat_composites layer.
+        """
+        args = self.request.arguments()
+        params = dict(zip(args, map(self.request.get, args)))
+        bbox = params.get('bbox')
+        if bbox:
+            bbox = map(float, bbox.split(','))
+        job = seed.start(params['layer'], int(params['zmin']),
+                         int(params['zmax']), bbox=bbox,
+                         iso=params.get('iso'), year=params.get('year'))
+        self._send_json(job.progress())
+
+    def run(self):
+        """Seeds one batch of tiles, run from the tile-seed queue."""
+        position, retries = map(self.request.get, ['position', 'retries'])
+        seed.run(int(self.request.get('job')),
+                 int(position) if position else None,
+                 int(retries) if retries else None)
+
+    def resume(self):
+        """Re-enqueues a stopped job from its last recorded position, or
+        retries the metatiles of a done job that failed to seed."""
+        job = seed.SeedJob.get_by_id(int(self.request.get('job')))
+        if not job:
+            self.error(404)
+            return
+        self._send_json(seed.resume(job).progress())
+
+    def status(self):
+        """Reports progress and throughput of one job or recent jobs."""
+        job_id = self.request.get('job')
+        if job_id:
+            jobs = filter(None, [seed.SeedJob.get_by_id(int(job_id))])
+        else:
+            jobs = seed.SeedJob.query().order(-seed.SeedJob.created).fetch(20)
+        self._send_json([job.progress() for job in jobs])
+
+
+class PubsubEvents(JsonHandler):
+    def status(self):
+        """Reports fan-out progress and throughput of one or recent events."""
+        event_id = self.request.get('event')
+        if event_id:
+            events = filter(None, [pubsub.Event.get_by_id(int(event_id))])
+        else:
+            events = pubsub.Event.query().order(
+                -pubsub.Event.created).fetch(20)
+        self._send_json([e.progress() for e in events])
+
+    def resume(self):
+        """Restarts an event's publish chain from its recorded cursor."""
+        e = pubsub.Event.get_by_id(int(self.request.get('event')))
+        if not e:
+            self.error(404)
+            return
+        self._send_json(pubsub.resume(e).progress())
+
+
+class MailMetrics(JsonHandler):
+    def get(self):
+        """Reports recent mail dispatch rates and backoff."""
+        self._send_json(mailer.metrics())
+
+
 routes = [
     webapp2.Route(r'/admin/bootstrap-gcs', handler='admin.BootstrapGcs:get'),
+    webapp2.Route(r'/admin/alert-counts/refresh',
+                  handler='admin.RefreshAlertCounts:get'),
+    webapp2.Route(r'/admin/outlines/refresh',
+                  handler='admin.RefreshOutlines:get'),
+    webapp2.Route(r'/admin/mail', handler='admin.MailMetrics:get'),
+    webapp2.Route(r'/admin/pubsub', handler='admin.PubsubEvents:status'),
+    webapp2.Route(r'/admin/pubsub/resume',
+                  handler='admin.PubsubEvents:resume'),
+    webapp2.Route(r'/admin/seed', handler='admin.SeedTiles:status'),
+    webapp2.Route(r'/admin/seed/start', handler='admin.SeedTiles:start'),
+    webapp2.Route(r'/admin/seed/resume', handler='admin.SeedTiles:resume'),
+    webapp2.Route(seed.RUN_ROUTE, handler='admin.SeedTiles:run',
+                  methods=['POST']),
 ]
 
 handlers = webapp2.WSGIApplication(routes, debug=True)
@@ -23,8 +23,10 @@ import traceback
 
 from appengine_config import runtime_config
 
-from gfw import forma, imazon, modis, umd, gcs
+from gfw import forma, imazon, modis, umd, gcs, lru
+from gfw.singleflight import SingleFlight
 
+from google.appengine.api import memcache
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.ext import ndb
@@ -35,6 +37,21 @@ _DATASETS = ['imazon', 'forma', 'modis', 'umd']
 # Analysis route.
 _ROUTE = r'/datasets/<dataset:(%s)>' % '|'.join(_DATASETS)
 
+# Analysis cache tiers, fastest first.
+_TIERS = ['lru', 'memcache', 'datastore', 'gcs']
+
+# Max number of analysis results kept in instance memory.
+_LRU_SIZE = 512
+
+# Seconds analysis results live in memcache and instance memory.
+_MEMCACHE_TTL = 60 * 60 * 24
+
+# Memcache namespace for analysis results.
+_NAMESPACE = 'analysis'
+
+# Coalesces concurrent analysis requests with the same id.
+_flights = SingleFlight()
+
 
 def _analyze(dataset, params):
     if dataset == 'imazon':
@@ -67,6 +84,26 @@ class GCSServingHandler(blobstore_handlers.BlobstoreDownloadHandler):
 
 
 class Cache():
+    """Read-through analysis cache.
+
+    Tiers are consulted in order (instance LRU, memcache, datastore, GCS) and
+    hits are promoted to every tier above the one that served them.
+    """
+
+    lru = lru.LRUCache(_LRU_SIZE, ttl=_MEMCACHE_TTL)
+
+    counters = dict((tier, dict(hits=0, misses=0)) for tier in _TIERS)
+
+    @classmethod
+    def _count(cls, tier, hit):
+        cls.counters[tier]['hits' if hit else 'misses'] += 1
+
+    @classmethod
+    def stats(cls):
+        """Return hit/miss counters per tier for this instance."""
+        return dict((tier, dict(counts))
+                    for tier, counts in cls.counters.iteritems())
+
     @classmethod
     def forma(cls, key, params):
         params['dataset'] = 'forma'
@@ -77,21 +114,63 @@ class Cache():
             blobstore_filename = '/gs%s' % gcs_path
             blob_key = blobstore.create_gs_key(blobstore_filename)
             blob_reader = blobstore.BlobReader(blob_key)
-            value = blob_reader.read()
-            entry = AnalysisEntry(id=blob_key, value=value)
-            entry.put()
-            return entry
+            return blob_reader.read()
 
     @classmethod
-    def get(cls, key, dataset, params, bust):
-        if not bust:
-            entry = AnalysisEntry.get_by_id(key)
-            if entry:
-                return entry
+    def _gcs(cls, key, dataset, params):
         if dataset == 'forma':
             if 'iso' in params:
                 return cls.forma(key, params)
 
+    @classmethod
+    def set(cls, key, value, tiers=_TIERS):
+        """Write supplied value to the given cache tiers."""
+        if 'lru' in tiers:
+            cls.lru.set(key, value)
+        if 'memcache' in tiers:
+            memcache.set(key, value, time=_MEMCACHE_TTL,
+                         namespace=_NAMESPACE)
+        if 'datastore' in tiers:
+            AnalysisEntry(id=key, value=value).put()
+
+    @classmethod
+    def shared(cls, key):
+        """Return value from the cache tier shared by all instances."""
+        return memcache.get(key, namespace=_NAMESPACE)
+
+    @classmethod
+    def get(cls, key, dataset, params, bust):
+        """Return cached analysis value for supplied key or None.
+
+        When busting, only the precomputed GCS tier is consulted.
+        """
+        if not bust:
+            value = cls._cached(key)
+            if value is not None:
+                return value
+        value = cls._gcs(key, dataset, params)
+        cls._count('gcs', value is not None)
+        if value is not None:
+            cls.set(key, value)
+            return value
+
+    @classmethod
+    def _cached(cls, key):
+        value = cls.lru.get(key)
+        cls._count('lru', value is not None)
+        if value is not None:
+            return value
+        value = memcache.get(key, namespace=_NAMESPACE)
+        cls._count('memcache', value is not None)
+        if value is not None:
+            cls.set(key, value, tiers=['lru'])
+            return value
+        entry = AnalysisEntry.get_by_id(key)
+        cls._count('datastore', entry is not None)
+        if entry:
+            cls.set(key, entry.value, tiers=['lru', 'memcache'])
+            return entry.value
+
 
 class AnalysisEntry(ndb.Model):
     """Analysis cache entry for datastore."""
@@ -115,6 +194,17 @@ class Analysis(common.BaseApi):
     def get(self, dataset):
         self.post(dataset)
 
+    def _compute(self, rid, dataset, params):
+        """Run analysis, cache the JSON result and return it."""
+        response = _analyze(dataset, params)
+        if dataset == 'umd':
+            value = json.dumps(response)
+        else:
+            result = _parse_analysis(dataset, response.content)
+            value = json.dumps(result)
+        Cache.set(rid, value)
+        return value
+
     def post(self, dataset):
         params = self._get_params()
         rid = self._get_id(params)
@@ -122,16 +212,13 @@ class Analysis(common.BaseApi):
         if bust:
             params.pop('bust')
 
-        entry = Cache.get(rid, dataset, params, bust)
-        if entry:
-            self._send_response(entry.value)
-        else:
-            response = None
-            error = None
+        value = Cache.get(rid, dataset, params, bust)
+        if value is None:
             try:
-                response = _analyze(dataset, params)
-            except Exception, e:
-                error = e
+                value = _flights.do(
+                    rid, lambda: self._compute(rid, dataset, params),
+                    lookup=lambda: Cache.shared(rid))
+            except Exception, error:
                 name = error.__class__.__name__
                 trace = traceback.format_exc()
                 if dataset == 'umd':
@@ -144,15 +231,7 @@ class Analysis(common.BaseApi):
                             headers=self.request.headers)
                 self._send_error()
                 return
-            if dataset == 'umd':
-                value = json.dumps(response)
-                AnalysisEntry(id=rid, value=value).put()
-                self._send_response(value)
-            else:
-                result = _parse_analysis(dataset, response.content)
-                value = json.dumps(result)
-                AnalysisEntry(id=rid, value=value).put()
-                self._send_response(value)
+        self._send_response(value)
 
 
 routes = [webapp2.Route(_ROUTE, handler=Analysis)]
@@ -21,6 +21,8 @@ import webapp2
 
 from hashlib import md5
 
+from gfw import geometry
+
 
 def _get_request_params(request, body=False):
     """Return params as a dictionary for supplied HTTP request."""
@@ -38,6 +40,7 @@ def _get_request_id(request, params):
     path, fmt = request.path.lower().split('.')
     fmt = fmt if fmt != 'shp' else 'zip'
     whitespace = re.compile(r'\s+')
+    params = geometry.normalize_params(params)
     params = re.sub(whitespace, '', json.dumps(params, sort_keys=True))
     return '%s/%s.%s' % (path, md5(params).hexdigest(), fmt)
 
@@ -47,6 +50,7 @@ class BaseApi(webapp2.RequestHandler):
 
     def _get_id(self, params):
         whitespace = re.compile(r'\s+')
+        params = geometry.normalize_params(params)
         params = re.sub(whitespace, '', json.dumps(params, sort_keys=True))
         return '/'.join([self.request.path.lower(), md5(params).hexdigest()])
 
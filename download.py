@@ -23,6 +23,7 @@ import traceback
 from appengine_config import runtime_config
 
 from gfw import forma, imazon, modis, gcs
+from gfw.singleflight import SingleFlight
 
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
@@ -51,6 +52,16 @@ _CONTENT_TYPES = {
     'geojson': 'application/json',
 }
 
+# Bytes written to GCS per chunk when persisting exports.
+_CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for CartoDB when fetching exports, leaving the request
+# time to write them to GCS.
+_FETCH_DEADLINE = 50
+
+# Coalesces concurrent download requests with the same id.
+_flights = SingleFlight()
+
 
 class Cache():
     @classmethod
@@ -70,8 +81,10 @@ class Cache():
     @classmethod
     def get(cls, key, dataset, params, fmt, bust):
         if not bust:
+            # Exports too large to store only have their CartoDB URL, which
+            # is redirected to rather than fetched again.
             entry = DownloadEntry.get_by_id(key)
-            if entry and entry.blob_key:
+            if entry and (entry.blob_key or entry.cdb_url):
                 return entry
         if dataset == 'forma':
             return cls.forma(key, params, fmt)
@@ -87,6 +100,34 @@ def _download(dataset, params):
     raise ValueError('Unsupported dataset for download: %s' % dataset)
 
 
+def _fetch(url):
+    """Return content of CartoDB export at url.
+
+    urlfetch returns the whole body at once, so exports over its 32MB limit
+    raise urlfetch.ResponseTooLargeError.
+    """
+    response = urlfetch.fetch(url, deadline=_FETCH_DEADLINE)
+    if response.status_code != 200:
+        raise Exception('CartoDB export failed (status=%s, content=%s)' %
+                        (response.status_code, response.content[:512]))
+    return response.content
+
+
+def _persist(rid, url, fmt, content=None):
+    """Write CartoDB export at url, or its already fetched content, to GCS
+    in chunks and return the DownloadEntry recording the blob."""
+    if content is None:
+        content = _fetch(url)
+    gcs_file, blobstore_filename = gcs.open_file(rid, _CONTENT_TYPES[fmt])
+    for i in xrange(0, len(content), _CHUNK_SIZE):
+        gcs_file.write(content[i:i + _CHUNK_SIZE])
+    gcs_file.close()
+    blob_key = blobstore.create_gs_key(blobstore_filename)
+    entry = DownloadEntry(id=rid, cdb_url=url, blob_key=blob_key)
+    entry.put()
+    return entry
+
+
 class DownloadEntry(ndb.Model):
     """Download cache entry for datastore."""
     cdb_url = ndb.TextProperty()
@@ -116,6 +157,30 @@ class Download(blobstore_handlers.BlobstoreDownloadHandler):
     def get(self, dataset, fmt):
         self.post(dataset, fmt)
 
+    def _export(self, rid, dataset, params, fmt):
+        """Run export on CartoDB once, write it to GCS and return the entry
+        for its blob.
+
+        The fetch replaces the HEAD request that used to check the export,
+        so CartoDB runs it once and this and repeat requests are served from
+        the blob. Exports over the 32MB urlfetch limit can't be stored and
+        only have their URL cached for a redirect.
+        """
+        url = _download(dataset, params)
+        try:
+            content = _fetch(url)
+        except urlfetch.ResponseTooLargeError:
+            entry = DownloadEntry(id=rid, cdb_url=url)
+            entry.put()
+            return entry
+        return _persist(rid, url, fmt, content)
+
+    def _lookup(self, rid):
+        """Return export entry cached by another instance or None."""
+        entry = DownloadEntry.get_by_id(rid)
+        if entry and (entry.blob_key or entry.cdb_url):
+            return entry
+
     def post(self, dataset, fmt):
         params = common._get_request_params(self.request)
         params['format'] = fmt
@@ -123,26 +188,25 @@ class Download(blobstore_handlers.BlobstoreDownloadHandler):
         bust = params.get('bust')
 
         entry = Cache.get(rid, dataset, params, fmt, bust)
-        if entry and entry.blob_key:
-            self.send_blob(entry.blob_key)
-        elif entry and entry.cdb_url:
-            self._redirect(entry.cdb_url)
-        else:
-            url = None
+        if not (entry and (entry.blob_key or entry.cdb_url)):
             try:
-                url = _download(dataset, params)
-                urlfetch.fetch(url, method='HEAD', deadline=50)
+                entry = _flights.do(
+                    rid, lambda: self._export(rid, dataset, params, fmt),
+                    lookup=lambda: self._lookup(rid))
             except Exception, error:
                 name = error.__class__.__name__
                 trace = traceback.format_exc()
-                msg = 'CartoDB %s download failure: %s: %s - URL: %s' % \
-                    (dataset, name, error, url)
+                msg = 'CartoDB %s download failure: %s: %s' % \
+                    (dataset, name, error)
                 monitor.log(self.request.url, msg, error=trace,
                             headers=self.request.headers)
                 self._send_error()
                 return
-            DownloadEntry(id=rid, cdb_url=url).put()
-            self._redirect(url)
+        if entry.blob_key:
+            self.send_blob(entry.blob_key)
+        else:
+            self._redirect(entry.cdb_url)
+
 
 routes = [webapp2.Route(_ROUTE, handler=Download)]
 
@@ -27,8 +27,10 @@ import monitor
 import logging
 
 from gfw import common
+from gfw import geometry
 from gfw import countries
 from gfw import stories
+from gfw import mailer
 from gfw import pubsub
 from gfw import wdpa
 from appengine_config import runtime_config
@@ -77,6 +79,7 @@ class BaseApi(webapp2.RequestHandler):
 
     def _get_id(self, params):
         whitespace = re.compile(r'\s+')
+        params = geometry.normalize_params(params)
         params = re.sub(whitespace, '', json.dumps(params, sort_keys=True))
         return '/'.join([self.request.path.lower(), md5(params).hexdigest()])
 
@@ -274,6 +277,9 @@ routes = [
     webapp2.Route(r'/pubsub/notify', handler=pubsub.Notifier,
                   handler_method='post',
                   methods=['POST']),
+    webapp2.Route(mailer.DISPATCH_ROUTE, handler=mailer.Dispatcher,
+                  handler_method='post',
+                  methods=['POST']),
     webapp2.Route(r'/subscribe', handler=PubSubApi,
                   handler_method='subscribe',
                   methods=['POST']),
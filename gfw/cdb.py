@@ -15,12 +15,29 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-"""This module supports executing CartoDB queries."""
+"""This module supports executing CartoDB queries.
 
+Queries go through a shared CartoDBClient whose transport is pluggable:
+urlfetch RPCs on App Engine, a pool of keep-alive HTTP connections elsewhere,
+or canned responses standing in for CartoDB when running locally.
+"""
+
+import httplib
+import json
+import logging
+import math
+import random
+import threading
+import time
 import urllib
+import urlparse
 
 from appengine_config import runtime_config
-from google.appengine.api import urlfetch
+
+try:
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
 
 # CartoDB endpoint:
 if runtime_config.get('cdb_endpoint'):
@@ -28,6 +45,13 @@ if runtime_config.get('cdb_endpoint'):
 else:
     ENDPOINT = 'http://wri-01.cartodb.com/api/v2/sql'
 
+# Seconds to wait for a single CartoDB response.
+DEADLINE = 50
+
+# Seconds a query may take across all its attempts, keeping retries within
+# the 60 second request deadline.
+TOTAL_DEADLINE = 55
+
 
 def _get_api_key():
     """Return CartoDB API key stored in cdb.txt file."""
@@ -60,9 +84,254 @@ def get_body(query, params, auth=False):
     return body
 
 
-def execute(query, params={}, auth=False):
-    """Exectues supplied query on CartoDB and returns response body as JSON."""
-    rpc = urlfetch.create_rpc(deadline=50)
-    payload = get_body(query, params, auth=auth)
-    urlfetch.make_fetch_call(rpc, ENDPOINT, method='POST', payload=payload)
-    return rpc.get_result()
+class Response(object):
+    """CartoDB response exposing the attributes of a urlfetch result."""
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.elapsed = None
+
+
+class RetryParams(object):
+    """Retry and exponential backoff settings for CartoDB queries."""
+
+    def __init__(self, max_retries=2, initial_delay=0.2, max_delay=5.0,
+                 backoff_factor=2, retry_statuses=(429, 500, 502, 503, 504),
+                 total_deadline=TOTAL_DEADLINE):
+        self.max_retries = max_retries
+        self.total_deadline = total_deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = retry_statuses
+
+    def delay(self, attempt):
+        """Return jittered seconds to sleep before supplied retry attempt."""
+        delay = self.initial_delay * math.pow(self.backoff_factor, attempt)
+        return min(self.max_delay, delay) * random.uniform(0.5, 1.0)
+
+
+class UrlfetchTransport(object):
+    """Transport issuing asynchronous App Engine urlfetch RPCs."""
+
+    def __init__(self, endpoint=ENDPOINT):
+        self.endpoint = endpoint
+
+    def start(self, payload, deadline):
+        rpc = urlfetch.create_rpc(deadline=deadline)
+        urlfetch.make_fetch_call(rpc, self.endpoint, method='POST',
+                                 payload=payload)
+        return rpc
+
+    def finish(self, rpc):
+        result = rpc.get_result()
+        return Response(result.status_code, result.content, result.headers)
+
+
+class _Request(threading.Thread):
+    """Runs a blocking request on its own thread."""
+
+    def __init__(self, fn, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fn = fn
+        self.args = args
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception, e:
+            self.error = e
+
+
+class HttpPoolTransport(object):
+    """Transport reusing a bounded pool of keep-alive HTTP connections."""
+
+    HEADERS = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Connection': 'keep-alive',
+    }
+
+    def __init__(self, endpoint=ENDPOINT, size=8):
+        url = urlparse.urlparse(endpoint)
+        if url.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self.host = url.netloc
+        self.path = url.path
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connection(self, deadline):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connection_class(self.host, timeout=deadline)
+
+    def _request(self, payload, deadline):
+        with self._slots:
+            conn = self._connection(deadline)
+            try:
+                conn.request('POST', self.path, payload, self.HEADERS)
+                response = conn.getresponse()
+                content = response.read()
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+            return Response(response.status, content,
+                            dict(response.getheaders()))
+
+    def start(self, payload, deadline):
+        request = _Request(self._request, payload, deadline)
+        request.start()
+        return request
+
+    def finish(self, request):
+        request.join()
+        if request.error:
+            raise request.error
+        return request.result
+
+
+class StubTransport(object):
+    """Transport standing in for CartoDB with canned responses.
+
+    Responses are keyed by SQL query and recorded queries are kept in
+    self.queries, for local runs without CartoDB access.
+    """
+
+    def __init__(self, responses=None, default=None):
+        self.responses = responses or {}
+        self.default = default or dict(rows=[], total_rows=0)
+        self.queries = []
+
+    def start(self, payload, deadline):
+        query = urlparse.parse_qs(payload).get('q', [''])[0]
+        self.queries.append(query)
+        response = self.responses.get(query, self.default)
+        if isinstance(response, Response):
+            return response
+        return Response(200, json.dumps(response))
+
+    def finish(self, response):
+        return response
+
+
+def _default_transport():
+    name = runtime_config.get('cdb_transport')
+    if name == 'stub':
+        return StubTransport()
+    if name == 'http' or urlfetch is None:
+        return HttpPoolTransport(ENDPOINT)
+    return UrlfetchTransport(ENDPOINT)
+
+
+class Future(object):
+    """Pending CartoDB query, retried on failure when its result is read.
+
+    Writes must pass retry=False, since a failed attempt may still have been
+    committed and retrying it would apply the write twice.
+    """
+
+    def __init__(self, client, payload, deadline, retry=True):
+        self.client = client
+        self.payload = payload
+        self.deadline = deadline
+        self.retry = retry
+        self.attempt = 0
+        self._started = time.time()
+        self._handle = client.transport.start(payload, deadline)
+
+    def _retry(self, reason):
+        retry = self.client.retry_params
+        if not self.retry or self.attempt >= retry.max_retries:
+            return False
+        delay = retry.delay(self.attempt)
+        remaining = retry.total_deadline - (time.time() - self._started) - \
+            delay
+        if remaining < 1:
+            return False
+        logging.info('CARTODB RETRY %s in %.2fs (%s)' %
+                     (self.attempt + 1, delay, reason))
+        time.sleep(delay)
+        self.attempt += 1
+        self._handle = self.client.transport.start(
+            self.payload, min(self.deadline, remaining))
+        return True
+
+    def get_result(self):
+        """Block until the query completes and return its Response."""
+        while True:
+            try:
+                response = self.client.transport.finish(self._handle)
+            except Exception, e:
+                if self._retry(e.__class__.__name__):
+                    continue
+                raise
+            statuses = self.client.retry_params.retry_statuses
+            if response.status_code in statuses and \
+                    self._retry(response.status_code):
+                continue
+            response.elapsed = time.time() - self._started
+            return response
+
+
+class CartoDBClient(object):
+    """CartoDB SQL API client shared by the dataset modules."""
+
+    def __init__(self, transport=None, retry_params=None, deadline=DEADLINE):
+        self.transport = transport or _default_transport()
+        self.retry_params = retry_params or RetryParams()
+        self.deadline = deadline
+
+    def execute_async(self, query, params=None, auth=False, retry=True):
+        """Start supplied query and return a Future for its response.
+
+        Args:
+          retry: False for writes, which must not be retried.
+        """
+        payload = get_body(query, dict(params or {}), auth=auth)
+        return Future(self, payload, self.deadline, retry)
+
+    def execute(self, query, params=None, auth=False, retry=True):
+        """Execute supplied query and return its response."""
+        return self.execute_async(query, params, auth=auth,
+                                  retry=retry).get_result()
+
+    def execute_many(self, queries, params=None, auth=False, retry=True):
+        """Execute supplied queries concurrently and return their responses
+        in the same order."""
+        futures = [self.execute_async(query, params, auth=auth, retry=retry)
+                   for query in queries]
+        return [future.get_result() for future in futures]
+
+
+client = CartoDBClient()
+
+
+def execute(query, params={}, auth=False, retry=True):
+    """Exectues supplied query on CartoDB and returns response body as JSON.
+
+    Pass retry=False for writes."""
+    return client.execute(query, params, auth=auth, retry=retry)
+
+
+def execute_async(query, params={}, auth=False, retry=True):
+    """Start supplied query on CartoDB and return a Future for it."""
+    return client.execute_async(query, params, auth=auth, retry=retry)
+
+
+def execute_many(queries, params={}, auth=False, retry=True):
+    """Execute supplied queries on CartoDB concurrently."""
+    return client.execute_many(queries, params, auth=auth, retry=retry)
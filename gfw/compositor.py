@@ -0,0 +1,141 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports compositing map tiles into a single image.
+
+Tiles are collected first and drawn in one pass onto a canvas the size of
+the output, with offsets shifted by the crop box so cropping happens as
+they are drawn. Layers are drawn bottom up and blended by their alpha
+times their opacity.
+
+The App Engine images backend is used when available, otherwise PIL, which
+also runs locally.
+"""
+
+import collections
+import contextlib
+import logging
+import time
+from StringIO import StringIO
+
+from gfw import png
+
+try:
+    from google.appengine.api import images
+except ImportError:
+    images = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class AppEngineBackend(object):
+    """Composites with the App Engine images API."""
+
+    # Inputs images.composite accepts per call.
+    MAX_INPUTS = images.MAX_COMPOSITES_PER_REQUEST if images else 16
+
+    def render(self, layers, width, height, timer):
+        """Return PNG of (content, x, y, opacity) layers drawn in order."""
+        image = None
+        with timer('composite'):
+            while layers:
+                inputs = [(image, 0, 0, 1.0, images.TOP_LEFT)] if image else []
+                count = self.MAX_INPUTS - len(inputs)
+                inputs.extend((content, x, y, opacity, images.TOP_LEFT)
+                              for content, x, y, opacity in layers[:count])
+                layers = layers[count:]
+                image = images.composite(inputs, width, height, color=0,
+                                         output_encoding=images.PNG)
+        return image
+
+
+class PILBackend(object):
+    """Composites with PIL."""
+
+    def render(self, layers, width, height, timer):
+        """Return PNG of (content, x, y, opacity) layers drawn in order."""
+        with timer('decode'):
+            tiles = [(Image.open(StringIO(content)).convert('RGBA'), x, y,
+                      opacity) for content, x, y, opacity in layers]
+        with timer('composite'):
+            canvas = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+            for tile, x, y, opacity in tiles:
+                if opacity < 1.0:
+                    alpha = tile.split()[3].point(lambda a: int(a * opacity))
+                    tile.putalpha(alpha)
+                layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+                layer.paste(tile, (x, y))
+                canvas = Image.alpha_composite(canvas, layer)
+        with timer('encode'):
+            output = StringIO()
+            canvas.save(output, 'PNG')
+        return output.getvalue()
+
+
+def default_backend():
+    if images:
+        return AppEngineBackend()
+    if Image:
+        return PILBackend()
+    raise ImportError('Compositing needs the App Engine images API or PIL')
+
+
+class Compositor(object):
+    """Collects tiles and composites them in a single pass.
+
+    Args:
+      backend: AppEngineBackend or PILBackend, default_backend() if None.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or default_backend()
+        self.layers = []
+        self.timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Add the time spent in the with block to stage's timing."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0) + \
+                time.time() - start
+
+    def add(self, content, x, y, opacity=1.0, z=0):
+        """Add tile PNG content with its top left corner at pixel x, y.
+
+        Tiles are drawn by increasing z, then in the order added.
+        """
+        self.layers.append((z, len(self.layers), content, x, y, opacity))
+
+    def render(self, left, top, width, height, size=256):
+        """Return PNG of the width x height box at pixel left, top."""
+        layers = [(content, x - left, y - top, opacity)
+                  for z, i, content, x, y, opacity in sorted(self.layers)
+                  if x - left < width and y - top < height and
+                  x - left + size > 0 and y - top + size > 0]
+        if not layers:
+            return png.blank(width, height)
+        image = self.backend.render(layers, width, height, self.timer)
+        logging.info('COMPOSITE %s tiles %sx%s %s' % (
+            len(layers), width, height,
+            ' '.join('%s=%.3fs' % x for x in self.timings.iteritems())))
+        return image
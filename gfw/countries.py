@@ -18,7 +18,12 @@
 """This module supports accessing countries data."""
 
 import json
+import logging
 from gfw import cdb
+from gfw import counts
+
+# Alerts table behind the country alert counts.
+TABLE = 'cdm_latest'
 
 ALERTS_ALL_COUNT = """SELECT sum(alerts.count) AS alerts_count
   FROM gfw2_countries AS countries
@@ -52,6 +57,21 @@ GET_NO_ALERTS = GET = """SELECT countries.iso, countries.name, countries.enabled
   ORDER BY countries.name {order}"""
 
 
+LIST = """SELECT countries.iso, countries.name, countries.enabled,
+  countries.lat, countries.lng, countries.extent, countries.gva,
+  countries.gva_percent, countries.employment, countries.indepth,
+  countries.national_policy_link, countries.national_policy_title,
+  countries.convention_cbd, countries.convention_unfccc,
+  countries.convention_kyoto, countries.convention_unccd,
+  countries.convention_itta, countries.convention_cites,
+  countries.convention_ramsar, countries.convention_world_heritage,
+  countries.convention_nlbi, countries.convention_ilo, countries.ministry_link,
+  countries.external_links, countries.dataset_link, countries.emissions,
+  countries.carbon_stocks
+  FROM gfw2_countries AS countries
+  ORDER BY countries.name {order}"""
+
+
 GET = """SELECT countries.iso, countries.name, countries.enabled, countries.lat,
   countries.lng, countries.extent, countries.gva, countries.gva_percent,
   countries.employment, countries.indepth, countries.national_policy_link,
@@ -80,24 +100,95 @@ def has_alerts(params):
             HAS_ALERTS.format(**params)).content)['rows'][0]['count'] != 0
 
 
+def _rows(response):
+    return json.loads(response.content)['rows']
+
+
+def _log_timings(names, responses):
+    timings = ', '.join('%s=%.3fs' % (name, response.elapsed)
+                        for name, response in zip(names, responses))
+    logging.info('COUNTRIES CARTODB %s' % timings)
+
+
+def _is_default_interval(interval):
+    """Return True if interval matches the one used by ALERTS_ALL_COUNT."""
+    return ' '.join(interval.upper().split()) == '12 MONTHS'
+
+
+def _materialized(params):
+    """Return countries result using materialized alert counts, or None if
+    they aren't available for the requested interval."""
+    recent = counts.window(TABLE, '12 MONTHS')
+    window = counts.window(TABLE, params['interval'])
+    if recent is None or window is None:
+        return None
+    if 'iso' in params:
+        response = cdb.execute(GET_NO_ALERTS.format(**params))
+        _log_timings(['country'], [response])
+        countries = _rows(response)
+        isos = counts.load_isos()
+        if recent.get(params['iso'].upper()):  # Has forma alerts:
+            alerts_count = window.get(params['iso'].upper())
+            if alerts_count:
+                countries = [dict(x, alerts_count=alerts_count)
+                             for x in countries]
+            else:
+                countries = []
+    else:  # List all countries:
+        response = cdb.execute(LIST.format(**params))
+        _log_timings(['countries'], [response])
+        countries = _rows(response)
+        isos = [x['iso'] for x in countries]
+        for country in countries:
+            country['alerts_count'] = window.get(country['iso']) or None
+    return dict(total_count=counts.total(recent, isos), countries=countries)
+
+
 def get(params):
-    query = ALERTS_ALL_COUNT.format(**params)
-    alerts_count = json.loads(
-        cdb.execute(query, params).content)['rows'][0]['alerts_count']
     if not 'order' in params:
         params['order'] = ''
+    result = _materialized(params)
+    if result:
+        return result
     if 'iso' in params:
-        if has_alerts(params):  # Has forma alerts:
-            params['and'] = "AND iso = upper('%s')" % params['iso']
-            params['join'] = 'RIGHT'
-            query = GET.format(**params)
+        # GET is issued alongside the count and HAS_ALERTS, since most
+        # requested countries have alerts. GET_NO_ALERTS follows only for
+        # those that don't.
+        params['and'] = "AND iso = upper('%s')" % params['iso']
+        params['join'] = 'RIGHT'
+        names = ['total', 'has_alerts', 'alerts']
+        queries = [ALERTS_ALL_COUNT.format(**params),
+                   HAS_ALERTS.format(**params),
+                   GET.format(**params)]
+        responses = cdb.execute_many(queries, params)
+        _log_timings(names, responses)
+        total, has, alerts = responses
+        alerts_count = _rows(total)[0]['alerts_count']
+        if _rows(has)[0]['count'] != 0:  # Has forma alerts:
+            countries = _rows(alerts)
         else:  # No forma alerts:
-            query = GET_NO_ALERTS.format(**params)
+            response = cdb.execute(GET_NO_ALERTS.format(**params), params)
+            _log_timings(['no_alerts'], [response])
+            countries = _rows(response)
     else:  # List all countries:
         params['and'] = ''
         params['join'] = 'LEFT'
         query = GET.format(**params)
-    result = cdb.execute(query, params)
-    if result:
-        countries = json.loads(result.content)['rows']
+        if _is_default_interval(params['interval']):
+            # Same window as ALERTS_ALL_COUNT, so the total is the sum of
+            # the per country counts and one round trip is enough.
+            response = cdb.execute(query, params)
+            _log_timings(['countries'], [response])
+            countries = _rows(response)
+            alert_counts = [x['alerts_count'] for x in countries
+                            if x.get('alerts_count') is not None]
+            alerts_count = sum(alert_counts) if alert_counts else None
+        else:
+            names = ['total', 'countries']
+            queries = [ALERTS_ALL_COUNT.format(**params), query]
+            responses = cdb.execute_many(queries, params)
+            _log_timings(names, responses)
+            total, response = responses
+            alerts_count = _rows(total)[0]['alerts_count']
+            countries = _rows(response)
     return dict(total_count=alerts_count, countries=countries)
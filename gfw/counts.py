@@ -0,0 +1,266 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports materialized alert counts by country and date.
+
+Counts are stored in one AlertCounts entity per table and month, holding
+{date: {iso: count}}, under a per table parent key so reads right after a
+refresh are strongly consistent. A refresh only recomputes the latest
+stored month and any months after it.
+
+Each refresh also rebuilds an AlertIndex holding cumulative counts per ISO
+over the sorted dates, so the count between any begin and end dates, or
+over any trailing interval, takes two lookups.
+"""
+
+import bisect
+import calendar
+import datetime
+import json
+import logging
+import re
+import time
+
+from gfw import cdb
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# Alert tables with materialized counts.
+TABLES = ['cdm_latest', 'forma_api']
+
+# Earliest date considered when a table has no counts yet.
+EPOCH = datetime.date(2000, 1, 1)
+
+COUNTS = """SELECT iso, to_char(date, 'YYYY-MM-DD') AS date,
+  COUNT(*) AS count
+  FROM {table}
+  WHERE date >= '{since}'::date
+  GROUP BY iso, to_char(date, 'YYYY-MM-DD')"""
+
+COUNTRY_ISOS = """SELECT iso FROM gfw2_countries"""
+
+# Seconds an instance keeps an AlertIndex in memory.
+INDEX_TTL = 600
+
+# Seconds the COUNTRY_ISOS result is kept in memcache and instance memory.
+ISOS_TTL = 60 * 60 * 24
+
+# Matches ISO 8601 dates as stored in the index.
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+# Matches Postgres style intervals like '12 MONTHS' or '1 Months'.
+_INTERVAL = re.compile(r'^\s*(\d+)\s*(day|week|month|year)s?\s*$', re.I)
+
+
+def _parent(table):
+    return ndb.Key('AlertTable', table)
+
+
+class AlertCounts(ndb.Model):
+    """Alert counts for one table month keyed by date then ISO."""
+    table = ndb.StringProperty()
+    month = ndb.DateProperty()
+    counts = ndb.JsonProperty(compressed=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def latest(cls, table):
+        # Ids end in YYYY-MM, so the greatest id is the latest month.
+        keys = cls.query(ancestor=_parent(table)).fetch(keys_only=True)
+        return max(keys, key=lambda k: k.id()).get() if keys else None
+
+    @classmethod
+    def get_by_table(cls, table):
+        return cls.query(ancestor=_parent(table)).fetch()
+
+
+class AlertIndex(ndb.Model):
+    """Prefix sums of alert counts for a table, keyed by table name.
+
+    sums[iso][i] is the number of alerts for iso dated before dates[i], with
+    one extra trailing entry holding the total.
+    """
+    dates = ndb.JsonProperty(compressed=True)
+    sums = ndb.JsonProperty(compressed=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+# Instance cache of AlertIndex values: {table: (loaded, dates, sums)}.
+_indexes = {}
+
+# Instance cache of COUNTRY_ISOS: [loaded, isos].
+_isos = [0, None]
+
+
+def _month(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def _memcache_key(table):
+    return 'alert-counts-%s' % table
+
+
+def refresh(table):
+    """Recompute counts for the latest stored month onwards and return the
+    number of months written."""
+    latest = AlertCounts.latest(table)
+    since = latest.month if latest else EPOCH
+    query = COUNTS.format(table=table, since=since.isoformat())
+    response = cdb.execute(query)
+    if response.status_code != 200:
+        raise Exception('CartoDB Failed (status=%s, content=%s, q=%s)' %
+                        (response.status_code, response.content, query))
+    months = {}
+    for row in json.loads(response.content)['rows']:
+        date = datetime.datetime.strptime(row['date'], '%Y-%m-%d').date()
+        isos = months.setdefault(_month(date), {}).setdefault(row['date'], {})
+        isos[row['iso']] = isos.get(row['iso'], 0) + row['count']
+    entities = [
+        AlertCounts(id='%s-%s' % (table, month.strftime('%Y-%m')),
+                    parent=_parent(table), table=table, month=month,
+                    counts=month_counts)
+        for month, month_counts in months.iteritems()]
+    ndb.put_multi(entities)
+    build_index(table, entities)
+    logging.info('ALERT COUNTS %s refreshed %s months since %s' %
+                 (table, len(entities), since))
+    return len(entities)
+
+
+def build_index(table, written=()):
+    """Rebuild and store the AlertIndex for table from its counts.
+
+    Args:
+      written: AlertCounts just put, used over the stored ones so the index
+        includes them whatever the query returns.
+    """
+    entities = dict((e.key, e) for e in AlertCounts.get_by_table(table))
+    entities.update((e.key, e) for e in written)
+    counts = {}
+    for entity in entities.itervalues():
+        counts.update(entity.counts)
+    dates = sorted(counts.keys())
+    sums = {}
+    for i, date in enumerate(dates):
+        for iso, count in counts[date].iteritems():
+            sums.setdefault(iso, [0] * (len(dates) + 1))[i + 1] = count
+    for iso, values in sums.iteritems():
+        for i in xrange(1, len(values)):
+            values[i] += values[i - 1]
+    AlertIndex(id=table, dates=dates, sums=sums).put()
+    memcache.delete(_memcache_key('index-%s' % table))
+    _indexes.pop(table, None)
+
+
+def _load_index(table):
+    """Return (dates, sums) for table's AlertIndex or None."""
+    cached = _indexes.get(table)
+    if cached and time.time() - cached[0] < INDEX_TTL:
+        return cached[1:]
+    key = _memcache_key('index-%s' % table)
+    value = memcache.get(key)
+    if value is None:
+        entity = AlertIndex.get_by_id(table)
+        if not entity:
+            return None
+        value = (entity.dates, entity.sums)
+        memcache.set(key, value)
+    _indexes[table] = (time.time(),) + tuple(value)
+    return value
+
+
+def range_count(table, iso, begin, end):
+    """Return number of alerts for iso with begin <= date <= end, or None if
+    the table isn't indexed or the dates aren't YYYY-MM-DD."""
+    if not (_DATE.match(begin or '') and _DATE.match(end or '')):
+        return None
+    index = _load_index(table)
+    if index is None:
+        return None
+    dates, sums = index
+    values = sums.get(iso.upper())
+    if not values:
+        return 0
+    first = bisect.bisect_left(dates, begin)
+    last = bisect.bisect_right(dates, end)
+    if first >= last:
+        return 0
+    return values[last] - values[first]
+
+
+def since(interval, today=None):
+    """Return the date now() - INTERVAL 'interval' falls on, or None if the
+    interval isn't understood."""
+    match = _INTERVAL.match(interval or '')
+    if not match:
+        return None
+    today = today or datetime.datetime.utcnow().date()
+    n, unit = int(match.group(1)), match.group(2).lower()
+    if unit == 'day':
+        return today - datetime.timedelta(days=n)
+    if unit == 'week':
+        return today - datetime.timedelta(weeks=n)
+    months = n * 12 if unit == 'year' else n
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    month += 1
+    day = min(today.day, calendar.monthrange(year, month)[1])
+    return datetime.date(year, month, day)
+
+
+def window(table, interval):
+    """Return {iso: count} for alerts where date >= now() - interval, or None
+    if counts aren't materialized for table or the interval isn't supported.
+    """
+    begin = since(interval)
+    if begin is None:
+        return None
+    index = _load_index(table)
+    if index is None:
+        return None
+    dates, sums = index
+    # Dates compare to now() at midnight, so the cutoff day is excluded.
+    first = bisect.bisect_right(dates, begin.isoformat())
+    result = {}
+    for iso, values in sums.iteritems():
+        if values[-1] - values[first]:
+            result[iso] = values[-1] - values[first]
+    return result
+
+
+def load_isos():
+    """Return ISO codes listed in gfw2_countries, querying CartoDB at most
+    once per ISOS_TTL."""
+    if _isos[1] is not None and time.time() - _isos[0] < ISOS_TTL:
+        return _isos[1]
+    key = _memcache_key('isos')
+    isos = memcache.get(key)
+    if isos is None:
+        response = cdb.execute(COUNTRY_ISOS)
+        if response.status_code != 200:
+            raise Exception('CartoDB Failed (status=%s, content=%s, q=%s)' %
+                            (response.status_code, response.content,
+                             COUNTRY_ISOS))
+        isos = [row['iso'] for row in json.loads(response.content)['rows']]
+        memcache.set(key, isos, ISOS_TTL)
+    _isos[:] = [time.time(), isos]
+    return isos
+
+
+def total(counts, isos):
+    """Return summed counts for supplied ISO codes like SUM() would."""
+    values = [counts[iso] for iso in isos if counts.get(iso)]
+    return sum(values) if values else None
@@ -17,11 +17,18 @@
 
 """This module supports accessing FORMA data."""
 
+import collections
 import json
 from gfw import cdb
+from gfw import counts
+from gfw import countries
+from gfw import geometry
 
 FORMA_TABLE = 'forma_api'
 
+# FORMA resolution in meters.
+RESOLUTION = 500
+
 ISO_SUB_SQL = """SELECT SUM(count) as value, 'FORMA' as name, 'alerts' as unit,
   '500 meters' as resolution
 FROM
@@ -128,20 +135,52 @@ ALERTS_COUNTRY = """SELECT countries.iso, countries.name,
   AS alerts ON alerts.iso = countries.iso""" % FORMA_TABLE
 
 
+def _alerts_materialized(params):
+    """Return alerts using materialized alert counts, or None if they aren't
+    available."""
+    recent = counts.window(FORMA_TABLE, '12 MONTHS')
+    if recent is None:
+        return None
+    if 'iso' in params:
+        iso = params['iso'].upper()
+        query = countries.GET_NO_ALERTS.format(iso=iso, order='')
+        response = cdb.execute(query)
+        isos = counts.load_isos()
+        result = []
+        if recent.get(iso):
+            result = [dict(row, alerts_count=recent[iso], iso=iso)
+                      for row in json.loads(response.content)['rows']]
+    elif 'geom' in params:
+        window = counts.window(FORMA_TABLE, params.get('interval'))
+        if window is None:
+            return None
+        response = cdb.execute(countries.LIST.format(order=''))
+        result = json.loads(response.content)['rows']
+        isos = [row['iso'] for row in result]
+        for row in result:
+            row['alerts_count'] = window.get(row['iso']) or None
+    else:
+        raise AssertionError('geom or iso parameter required')
+    return dict(total_count=counts.total(recent, isos), countries=result)
+
+
 def alerts(params):
+    result = _alerts_materialized(params)
+    if result:
+        return result
     query = ALERTS_ALL_COUNT.format(**params)
     alerts_count = json.loads(
-        cdb.execute(query, params))['rows'][0]['alerts_count']
+        cdb.execute(query, params).content)['rows'][0]['alerts_count']
     if 'iso' in params:
         query = ALERTS_COUNTRY.format(**params)
         result = cdb.execute(query, params)
         if result:
-            result = json.loads(result)['rows']
+            result = json.loads(result.content)['rows']
     elif 'geom' in params:
         query = ALERTS_ALL_COUNTRIES.format(**params)
         result = cdb.execute(query, params)
         if result:
-            result = json.loads(result)['rows']
+            result = json.loads(result.content)['rows']
     else:
         raise AssertionError('geom or iso parameter required')
     return dict(total_count=alerts_count, countries=result)
@@ -149,6 +188,7 @@ def alerts(params):
 
 def download(params):
     """Return CartoDB download URL for supplied parameters."""
+    geometry.simplify_params(params, RESOLUTION, 'FORMA')
     if 'geom' in params:
         query = GEOJSON_GEOM_SQL.format(**params)
     elif 'iso' in params:
@@ -158,10 +198,27 @@ def download(params):
     return cdb.get_url(query, params=dict(format=params['format']))
 
 
+def _analyze_indexed(params):
+    """Return ISO_SQL equivalent response from the alert index or None."""
+    count = counts.range_count(FORMA_TABLE, params['iso'],
+                               params.get('begin'), params.get('end'))
+    if count is None:
+        return None
+    # Same keys and order as ISO_SQL rows, where SUM() of no rows is null.
+    row = collections.OrderedDict([
+        ('value', count or None), ('name', 'FORMA'), ('unit', 'alerts'),
+        ('resolution', '500 meters')])
+    return cdb.Response(200, json.dumps(dict(rows=[row], total_rows=1)))
+
+
 def analyze(params):
+    geometry.simplify_params(params, RESOLUTION, 'FORMA')
     if 'geom' in params:
         query = GEOJSON_SQL.format(**params)
     elif 'iso' in params:
+        response = _analyze_indexed(params)
+        if response:
+            return response
         query = ISO_SQL.format(**params)
     else:
         raise ValueError('FORMA analysis expects geom or iso parameter')
@@ -172,12 +229,21 @@ def parse_analysis(content):
     return json.loads(content)['rows'][0]
 
 
-def subsription(params):
+def _subscription_query(params):
     if 'geom' in params:
         params['geom'] = json.dumps(params.get('geom'))
-        query = GEOJSON_SUB_SQL.format(**params)
+        geometry.simplify_params(params, RESOLUTION, 'FORMA')
+        return GEOJSON_SUB_SQL.format(**params)
     elif 'iso' in params:
-        query = ISO_SUB_SQL.format(**params)
+        return ISO_SUB_SQL.format(**params)
     else:
         raise ValueError('FORMA subscription expects geom or iso param')
-    return cdb.execute(query)
+
+
+def subsription(params):
+    return cdb.execute(_subscription_query(params))
+
+
+def subsription_async(params):
+    """Start the subscription query and return a cdb.Future for it."""
+    return cdb.execute_async(_subscription_query(params))
@@ -20,8 +20,12 @@
 import cloudstorage as gcs
 import logging
 
+from cloudstorage import errors
+from cloudstorage import storage_api
+
 ANALYSIS_BUCKET = '/gfw-apis-analysis'
 COUNTRY_BUCKET = '/gfw-apis-country'
+TILE_BUCKET = '/gfw-apis-tiles'
 
 RETRY_PARAMS = gcs.RetryParams(initial_delay=0.2,
                                max_delay=5.0,
@@ -42,20 +46,60 @@ def exists(filename):
         return None
 
 
-def create_file(value, filename, content_type):
-    """Create a file.
+def open_file(filename, content_type):
+    """Open a file in the analysis bucket for streaming writes.
 
-    The retry_params specified in the open call will override the default
-    retry params for this particular file handle.
+    Writes are buffered and uploaded in chunks by the returned
+    cloudstorage StreamingBuffer; the file is finalized on close().
 
     Args:
-      filename: filename.
+      filename: filename, starting with a slash.
+      content_type: MIME type of the file.
+
+    Returns:
+      Tuple of the writable file and its blobstore filename.
     """
     path = ''.join([ANALYSIS_BUCKET, filename])
     gcs_file = gcs.open(path,
                         'w',
                         content_type=content_type,
                         options={})
+    return gcs_file, '/gs%s' % path
+
+
+def create_file(value, filename, content_type):
+    """Create a file.
+
+    The retry_params specified in the open call will override the default
+    retry params for this particular file handle.
+
+    Args:
+      filename: filename.
+    """
+    gcs_file, blobstore_filename = open_file(filename, content_type)
     gcs_file.write(value)
     gcs_file.close()
-    return '/gs%s' % path
+    return blobstore_filename
+
+
+def write_file(path, value, content_type):
+    """Write value to the object at path, e.g. '/bucket/filename'."""
+    gcs_file = gcs.open(path, 'w', content_type=content_type, options={})
+    gcs_file.write(value)
+    gcs_file.close()
+
+
+def read_range(path, offset, length):
+    """Return length bytes of the object at path starting at offset.
+
+    cloudstorage's ReadBuffer issues a HEAD and prefetches from offset 0
+    when opened, so this makes the single ranged GET itself.
+
+    Raises:
+      cloudstorage.NotFoundError: if the object doesn't exist.
+    """
+    api = storage_api._get_storage_api(retry_params=None)
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+    status, resp_headers, content = api.get_object(path, headers=headers)
+    errors.check_status(status, [200, 206], path, headers, resp_headers)
+    return content[:length]
@@ -19,9 +19,13 @@
 written by @andrewxhill."""
 
 import os
+import calendar
 import ee
+import hashlib
+import random
+import re
+import threading
 import time
-import math
 import webapp2
 import jinja2
 import httplib2
@@ -29,16 +33,27 @@ import json
 from oauth2client.appengine import AppAssertionCredentials
 from google.appengine.api import memcache
 import urllib
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 import config
 import logging
+from gfw import lru
+from gfw import metatiles
+from gfw import png
+from gfw.singleflight import SingleFlight
 from google.appengine.ext import ndb
 
 class TileEntry(ndb.Model):
+    value = ndb.BlobProperty()  # Only set on tiles stored before TileBlob.
+    etag = ndb.StringProperty(indexed=False)
+
+class TileBlob(ndb.Model):
+    """Tile PNG keyed by its etag, shared by every TileEntry with it."""
     value = ndb.BlobProperty()
 
 class MapIdEntry(ndb.Model):
-    value = ndb.TextProperty()
+    value = ndb.JsonProperty()
+    created = ndb.DateTimeProperty(auto_now=True)
 
 jinja_environment = jinja2.Environment(
         loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
@@ -51,6 +66,55 @@ GEE_SCOPE = 'https://www.googleapis.com/auth/earthengine.readonly'
 SCOPES = (GEE_SCOPE)
 credentials = AppAssertionCredentials(scope=SCOPES)
 
+# Seconds browsers and edge caches may keep tiles, by layer. Tiles never
+# change for a given layer, zoom, x, y and year.
+TILE_MAX_AGE = {
+  'landsat_composites': 60 * 60 * 24 * 30,
+  'l7_toa_1year_2012': 60 * 60 * 24 * 30,
+  'simple_green_coverage': 60 * 60 * 24 * 7,
+  'simple_bw_coverage': 60 * 60 * 24 * 7,
+  'masked_forest_carbon': 60 * 60 * 24 * 7,
+}
+DEFAULT_TILE_MAX_AGE = 60 * 60 * 24
+
+# Seconds a request may spend fetching a tile, retries included.
+TILE_DEADLINE = 20
+
+# Seconds a request may spend creating a map id, retries included.
+MAPID_DEADLINE = 20
+
+# Seconds after which a map id is still served but refreshed in the
+# background, and after which it is no longer served.
+MAPID_REFRESH_AGE = 60 * 60 * 12
+MAPID_MAX_AGE = 60 * 60 * 24
+
+# Memcache namespace of (mapid, created) by map id key.
+MAPID_NAMESPACE = 'mapid'
+
+# Task queue and route refreshing map ids in the background.
+MAPID_QUEUE = 'gee-mapid'
+MAPID_REFRESH_ROUTE = '/gee/mapid/refresh'
+
+# Memcache namespace of tile etags by tile key and tile PNGs by etag.
+TILE_NAMESPACE = 'tiles'
+
+# Seconds memcache keeps tile etags and PNGs.
+TILE_TTL = 90000
+
+# Tile PNGs kept in instance memory, mostly blank and uniform tiles shared
+# by many keys.
+TILE_LRU_SIZE = 256
+
+# Served for tiles Earth Engine has no data for and stored for tiles found
+# to be blank, so all blank tiles share one etag.
+BLANK_TILE = png.blank()
+BLANK_ETAG = hashlib.md5(BLANK_TILE).hexdigest()
+
+# Attempts and jittered exponential backoff for Earth Engine calls.
+RETRY_MAX_ATTEMPTS = 4
+RETRY_INITIAL_DELAY = 0.25
+RETRY_MAX_DELAY = 4
+
 class MainPage(webapp2.RequestHandler):
     def get(self):
 
@@ -66,162 +130,476 @@ class MainPage(webapp2.RequestHandler):
       self.response.out.write(template.render(template_values))
 
 
-class MapInit():
-  def __init__(self,reqid, request):
+class CircuitBreaker(object):
+  """Fails fast for an Earth Engine layer after repeated failures.
+
+  After threshold consecutive failures the circuit opens and calls for the
+  layer are refused for reset_timeout seconds, after which one trial call is
+  let through. State is kept per instance.
+  """
+
+  def __init__(self, threshold=5, reset_timeout=30):
+    self.threshold = threshold
+    self.reset_timeout = reset_timeout
+    self._failures = {}
+    self._opened = {}
+    self._lock = threading.Lock()
+
+  def allow(self, name):
+    with self._lock:
+      opened = self._opened.get(name)
+      if opened is None:
+        return True
+      if time.time() - opened < self.reset_timeout:
+        return False
+      # Half open: let this call through and hold others off again.
+      self._opened[name] = time.time()
+      return True
+
+  def success(self, name):
+    with self._lock:
+      self._failures.pop(name, None)
+      self._opened.pop(name, None)
+
+  def failure(self, name):
+    with self._lock:
+      failures = self._failures.get(name, 0) + 1
+      self._failures[name] = failures
+      if failures >= self.threshold:
+        if name not in self._opened:
+          logging.warning('CIRCUIT OPEN %s' % name)
+        self._opened[name] = time.time()
+
+
+breaker = CircuitBreaker()
+
+_blobs = lru.LRUCache(TILE_LRU_SIZE)
+
+# Etags this instance has seen stored as TileBlob.
+_stored = lru.LRUCache(TILE_LRU_SIZE * 4)
+
+_flights = SingleFlight(lease_ttl=MAPID_DEADLINE * 2)
+
+
+def _backoff(attempt):
+  """Return jittered seconds to wait before supplied retry attempt."""
+  return min(RETRY_MAX_DELAY, RETRY_INITIAL_DELAY * 2 ** attempt) * \
+    random.uniform(0.5, 1.0)
+
+
+def _with_retries(fn, name, deadline):
+  """Return fn() retried with jittered backoff within deadline seconds, or
+  None if it keeps failing or the circuit for name is open."""
+  start = time.time()
+  for attempt in range(RETRY_MAX_ATTEMPTS):
+    if not breaker.allow(name):
+      return None
+    try:
+      value = fn()
+      breaker.success(name)
+      return value
+    except Exception, e:
+      logging.info('RETRY %s (%s)' % (name, e.__class__.__name__))
+      breaker.failure(name)
+    delay = _backoff(attempt)
+    if time.time() - start + delay >= deadline:
+      return None
+    time.sleep(delay)
+
+
+def fetch_tiles(urls, name, deadline=TILE_DEADLINE):
+  """Fetch supplied tile URLs concurrently with urlfetch RPCs.
+
+  Failed fetches are retried together after a jittered backoff until they
+  succeed, the deadline budget is spent or the circuit for layer name
+  opens. Returns urlfetch results in URL order, None for failures.
+  """
+  start = time.time()
+  results = [None] * len(urls)
+  pending = range(len(urls))
+  for attempt in range(RETRY_MAX_ATTEMPTS):
+    remaining = deadline - (time.time() - start)
+    if not pending or remaining <= 0 or not breaker.allow(name):
+      break
+    rpcs = []
+    for i in pending:
+      rpc = urlfetch.create_rpc(deadline=remaining)
+      urlfetch.make_fetch_call(rpc, urls[i])
+      rpcs.append((i, rpc))
+    failed = []
+    for i, rpc in rpcs:
+      try:
+        result = rpc.get_result()
+        if result.status_code >= 500:
+          raise urlfetch.Error('status %s' % result.status_code)
+        results[i] = result
+        breaker.success(name)
+      except Exception, e:
+        logging.info('TILE RETRY %s (%s)' % (urls[i], e))
+        breaker.failure(name)
+        failed.append(i)
+    pending = failed
+    delay = _backoff(attempt)
+    if not pending or time.time() - start + delay >= deadline:
+      break
+    time.sleep(delay)
+  return results
+
+
+class Layer(object):
+  """A tile layer: an ee.Image built from request params, and how to
+  visualize it.
+
+  Args:
+    image: Function returning the layer's ee.Image, called with the
+      supplied params as keyword arguments.
+    vis: Visualization params passed to ee.data.getMapId.
+    params: Names of request params the image depends on.
+  """
+  def __init__(self, image, vis, params=()):
+    self.image = image
+    self.vis = vis
+    self.params = params
+
+
+def _green_coverage():
+  # The Green Forest Coverage background created by Andrew Hill
+  # example here: http://ee-api.appspot.com/#331746de9233cf1ee6a4afd043b1dd8f
+  treeHeight = ee.Image("Simard_Pinto_3DGlobalVeg_JGR")
+  elev = ee.Image('srtm90_v4')
+  mask2 = elev.gt(0).add(treeHeight.mask())
+  return treeHeight.mask(mask2)
+
+
+def _masked_forest_carbon():
+  forestCarbon = ee.Image("GME/images/06900458292272798243-10017894834323798527")
+  return forestCarbon.mask(forestCarbon)
+
+
+LAYERS = {
+  # landsat (L7) composites
+  # accepts a year, side effect map display of annual L7 cloud free composite
+  'landsat_composites': Layer(
+    lambda year: ee.Image("L7_TOA_1YEAR/" + year).select("30","20","10"),
+    {'min':1, 'max':100},
+    params=('year',)),
+
+  'l7_toa_1year_2012': Layer(
+    lambda: ee.Image("L7_TOA_1YEAR_2012"),
+    {'opacity': 1, 'bands':'30,20,10', 'min':10, 'max':120, 'gamma':1.6}),
+
+  'simple_green_coverage': Layer(
+    lambda: _green_coverage().mask(ee.Image("MOD44W/MOD44W_005_2000_02_24").select(["water_mask"]).eq(0)),
+    {'opacity': 1, 'min':0, 'max':50, 'palette':"dddddd,1b9567,333333"}),
+
+  'simple_bw_coverage': Layer(
+    _green_coverage,
+    {'opacity': 1, 'min':0, 'max':50, 'palette':"ffffff,777777,000000"}),
+
+  'masked_forest_carbon': Layer(
+    _masked_forest_carbon,
+    {'opacity': 0.5, 'min':1, 'max':200, 'palette':"FFFFD4,FED98E,FE9929,dd8653"}),
+}
+
+# Serialized layer images kept per instance, by layer and params.
+LAYER_CACHE_SIZE = 64
+
+_serialized = lru.LRUCache(LAYER_CACHE_SIZE)
+
+
+def _serialize(reqid, args):
+  """Return serialized ee.Image of layer reqid for args, building the
+  expression tree once per instance."""
+  key = (reqid,) + tuple(sorted(args.items()))
+  value = _serialized.get(key)
+  if value is None:
+    value = LAYERS[reqid].image(**args).serialize()
+    _serialized.set(key, value)
+  return value
+
+
+def _create_mapid(reqid, args):
+  params = dict(LAYERS[reqid].vis, image=_serialize(reqid, args))
+  response = ee.data.getMapId(params)
+  return dict(mapid=response['mapid'], token=response['token'])
+
+
+def _mapid_key(reqid, request):
+  """Return (key, args) identifying the map id for supplied layer, where
+  args are the request params its image depends on."""
+  layer = LAYERS.get(reqid)
+  if not layer:
+    return reqid, {}
+  args = dict((name, request.get(name) or '') for name in layer.params)
+  return reqid + ''.join(args[name] for name in layer.params), args
+
+
+def _load_mapid(key):
+  """Return cached (mapid, created) for key or None."""
+  cached = memcache.get(key, namespace=MAPID_NAMESPACE)
+  if cached is None:
+    entry = MapIdEntry.get_by_id(key)
+    if not entry or not entry.value or not entry.created:
+      return None
+    cached = (entry.value, calendar.timegm(entry.created.utctimetuple()))
+    memcache.set(key, cached, MAPID_MAX_AGE, namespace=MAPID_NAMESPACE)
+  return cached
+
+
+def _new_mapid(reqid, args, key):
+  """Create, store and return a map id, or None if the layer is unknown or
+  Earth Engine fails."""
+  if reqid not in LAYERS:
+    return None
+  deadline = time.time() + MAPID_DEADLINE
+  auth = _with_retries(
+    lambda: ee.Initialize(config.EE_CREDENTIALS, config.EE_URL) or True,
+    'ee-initialize', MAPID_DEADLINE)
+  if not auth:
+    return None
+  mapid = _with_retries(
+    lambda: _create_mapid(reqid, args), reqid,
+    max(deadline - time.time(), 0))
+  if mapid:
+    memcache.set(key, (mapid, time.time()), MAPID_MAX_AGE,
+                 namespace=MAPID_NAMESPACE)
+    MapIdEntry(id=key, value=mapid).put()
+    logging.info('MAPID %s created' % key)
+  return mapid
+
+
+def refresh_mapid(reqid, args, key, stale=None):
+  """Return a map id other than stale, creating one at most once at a time
+  per key across requests and instances."""
+  def lookup():
+    cached = memcache.get(key, namespace=MAPID_NAMESPACE)
+    if cached and cached[0] != stale:
+      return cached[0]
+  return lookup() or _flights.do(
+    key, lambda: _new_mapid(reqid, args, key), lookup)
+
+
+def _enqueue_refresh(reqid, args, key, created):
+  """Enqueue one background refresh per cached map id."""
+  name = re.sub(r'[^a-zA-Z0-9_-]', '_', 'mapid-%s-%d' % (key, created))
+  try:
+    taskqueue.add(url=MAPID_REFRESH_ROUTE, queue_name=MAPID_QUEUE,
+                  name=name, params=dict(args, layer=reqid))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
 
-      if reqid == 'landsat_composites':
-        year = request.get("year")
-        key = reqid + year
-      else:
-        key = reqid
-
-      self.mapid = memcache.get(key)
-      if not self.mapid: # cache miss
-        self.mapid = MapIdEntry.get_by_id(key)
-        if self.mapid: # datastore hit, update cache
-          memcache.put(key, self.mapid)          
-
-      if self.mapid is None:
-        
-        retry_count = 0
-        max_retries = 5
-        n = 1
-
-        auth = False
-
-        while retry_count < max_retries:
-          try:
-            ee.Initialize(config.EE_CREDENTIALS, config.EE_URL)
-            auth = True
-            break
-          except:
-            logging.info('RETRY AUTHENTICATION')
-            retry_count += 1
-            time.sleep(math.pow(2, n - 1))
-            n += 1
-            if auth:
-              break
-
-        if not auth or (retry_count == max_retries):
+
+class MapInit():
+  """Looks up the map id for a layer, stale-while-revalidate.
+
+  Map ids younger than MAPID_REFRESH_AGE are served from cache. Older ones
+  are still served while a task replaces them, and ones past MAPID_MAX_AGE,
+  or the supplied stale one Earth Engine rejected, are replaced before use.
+  """
+  def __init__(self, reqid, request, stale=None):
+      key, args = _mapid_key(reqid, request)
+      cached = _load_mapid(key)
+      if cached and cached[0] != stale:
+        mapid, created = cached
+        age = time.time() - created
+        if age < MAPID_MAX_AGE:
+          self.mapid = mapid
+          if age >= MAPID_REFRESH_AGE:
+            _enqueue_refresh(reqid, args, key, created)
           return
+      self.mapid = refresh_mapid(reqid, args, key,
+                                 stale=cached[0] if cached else None)
+
+def tile_key(m, z, x, y, year=''):
+  """Return cache key for supplied layer tile."""
+  return "%s-tile-%s-%s-%s-%s" % (m, z, x, y, year)
+
+
+def tile_url(mapid, z, x, y):
+  """Return Earth Engine URL for supplied tile of a map id."""
+  return "https://earthengine.googleapis.com/map/%s/%s/%s/%s?token=%s" % (mapid['mapid'], z, x, y, mapid['token'])
+
+
+def _tile_max_age(m):
+  """Return seconds clients and edge caches may keep tiles for layer m."""
+  return TILE_MAX_AGE.get(m.lower(), DEFAULT_TILE_MAX_AGE)
+
+
+def _etag(content):
+  return hashlib.md5(content).hexdigest()
+
+
+def _blob_key(etag):
+  return 'blob-%s' % etag
+
+
+def get_blob(etag):
+  """Return tile PNG with supplied etag from instance memory, memcache or
+  TileBlob, or None."""
+  if etag == BLANK_ETAG:
+    return BLANK_TILE
+  content = _blobs.get(etag)
+  if content is None:
+    content = memcache.get(_blob_key(etag), namespace=TILE_NAMESPACE)
+    if content is None:
+      blob = TileBlob.get_by_id(etag)
+      if not blob:
+        return None
+      content = blob.value
+      memcache.set(_blob_key(etag), content, TILE_TTL,
+                   namespace=TILE_NAMESPACE)
+    _blobs.set(etag, content)
+  return content
+
+
+def put_blob(content):
+  """Store tile PNG once by content and return its etag.
+
+  Cached bytes aren't proof of a TileBlob, since tiles read from metatiles
+  are cached without one, so the datastore is checked before skipping the
+  write.
+  """
+  etag = _etag(content)
+  if etag == BLANK_ETAG or _stored.get(etag):
+    return etag
+  if not TileBlob.get_by_id(etag):
+    TileBlob(id=etag, value=content).put()
+  _stored.set(etag, True)
+  _blobs.set(etag, content)
+  memcache.set(_blob_key(etag), content, TILE_TTL, namespace=TILE_NAMESPACE)
+  return etag
+
+
+def _entry_tile(entry):
+  """Return (etag, content) of supplied TileEntry."""
+  if entry.value is not None:
+    return entry.etag or _etag(entry.value), entry.value
+  content = get_blob(entry.etag)
+  return (entry.etag, content) if content is not None else None
+
+
+def get_cached_tiles(keys):
+  """Return {key: (etag, content)} for tiles cached in memcache or
+  TileEntry."""
+  found = {}
+  etags = memcache.get_multi(keys, namespace=TILE_NAMESPACE)
+  for key, etag in etags.iteritems():
+    content = get_blob(etag)
+    if content is not None:
+      found[key] = (etag, content)
+  missing = [ndb.Key(TileEntry, k) for k in keys if k not in found]
+  for entry in ndb.get_multi(missing):
+    tile = entry and _entry_tile(entry)
+    if tile:
+      found[entry.key.id()] = tile
+  return found
+
+
+def get_cached_tile(m, z, x, y, year=''):
+  """Return (etag, content) of cached tile or None, trying memcache, then
+  metatiles, then TileEntry."""
+  key = tile_key(m, z, x, y, year)
+  etag = memcache.get(key, namespace=TILE_NAMESPACE)
+  if etag:
+    content = get_blob(etag)
+    if content is not None:
+      return etag, content
+  cached = None
+  try:
+    content = metatiles.read(m, year, int(z), int(x), int(y))
+  except Exception, e:
+    logging.warning('METATILE READ %s (%s)' % (key, e))
+    content = None
+  if content is not None:
+    # The metatile is the durable copy, so no TileBlob is written. put_blob
+    # doesn't take these cached bytes as proof of one.
+    cached = (_etag(content), content)
+    _blobs.set(cached[0], content)
+    memcache.set(_blob_key(cached[0]), content, TILE_TTL,
+                 namespace=TILE_NAMESPACE)
+  else:
+    entry = TileEntry.get_by_id(key)
+    cached = entry and _entry_tile(entry)
+  if cached:
+    memcache.set(key, cached[0], TILE_TTL, namespace=TILE_NAMESPACE)
+  return cached
+
+
+def dedupe(content):
+  """Return BLANK_TILE for blank tile PNGs, else content."""
+  if content != BLANK_TILE and png.is_transparent(content):
+    return BLANK_TILE
+  return content
+
+
+def cache_tile(key, content):
+  """Cache tile content by reference to its deduplicated bytes and return
+  (etag, content)."""
+  content = dedupe(content)
+  etag = put_blob(content)
+  memcache.set(key, etag, TILE_TTL, namespace=TILE_NAMESPACE)
+  TileEntry(id=key, etag=etag).put()
+  return etag, content
 
-        retry_count = 0
-        max_retries = 5
-        n = 1
-
-        while retry_count < max_retries:
-          try:
-            if reqid == 'landsat_composites':
-              # landsat (L7) composites
-              # accepts a year, side effect map display of annual L7 cloud free composite
-              landSat = ee.Image("L7_TOA_1YEAR/" + year).select("30","20","10")
-              self.mapid = landSat.getMapId({'min':1, 'max':100})
-
-            if reqid == 'l7_toa_1year_2012':
-              self.mapid = ee.Image("L7_TOA_1YEAR_2012").getMapId(
-                {'opacity': 1, 
-                 'bands':'30,20,10', 
-                 'min':10, 
-                 'max':120, 
-                 'gamma':1.6})
-
-            if reqid == 'simple_green_coverage':
-              # The Green Forest Coverage background created by Andrew Hill
-              # example here: http://ee-api.appspot.com/#331746de9233cf1ee6a4afd043b1dd8f
-              treeHeight = ee.Image("Simard_Pinto_3DGlobalVeg_JGR")
-              elev = ee.Image('srtm90_v4')
-              mask2 = elev.gt(0).add(treeHeight.mask())
-              water = ee.Image("MOD44W/MOD44W_005_2000_02_24").select(["water_mask"]).eq(0)
-              self.mapid = treeHeight.mask(mask2).mask(water).getMapId({'opacity': 1, 'min':0, 'max':50, 'palette':"dddddd,1b9567,333333"})
-              
-
-            if reqid == 'simple_bw_coverage':
-              # The Green Forest Coverage background created by Andrew Hill
-              # example here: http://ee-api.appspot.com/#331746de9233cf1ee6a4afd043b1dd8f
-              treeHeight = ee.Image("Simard_Pinto_3DGlobalVeg_JGR")
-              elev = ee.Image('srtm90_v4')
-              mask2 = elev.gt(0).add(treeHeight.mask())
-              self.mapid = treeHeight.mask(mask2).getMapId({'opacity': 1, 'min':0, 'max':50, 'palette':"ffffff,777777,000000"})
-            
-            if reqid == 'masked_forest_carbon':
-              forestCarbon = ee.Image("GME/images/06900458292272798243-10017894834323798527")
-              self.mapid = forestCarbon.mask(forestCarbon).getMapId({'opacity': 0.5, 'min':1, 'max':200, 'palette':"FFFFD4,FED98E,FE9929,dd8653"})
-
-            # update cache and datastore
-            memcache.set(key, self.mapid)
-            MapIdEntry(id=key, value=self.mapid).put()
-
-            break
-          except:
-            logging.info('RETRY GET MAP ID %s' % reqid)
-            retry_count += 1
-            time.sleep(math.pow(2, n - 1))
-            n += 1
 
 # Depricated method, GFW will move to KeysGFW and not deliver tiles from the proxy directly
 class TilesGFW(webapp2.RequestHandler):
+    def _send_tile(self, m, etag, content):
+        self.response.headers['ETag'] = '"%s"' % etag
+        self.response.headers['Cache-Control'] = \
+          'public, max-age=%s' % _tile_max_age(m)
+        if etag in self.request.if_none_match:
+          self.response.set_status(304)
+          return
+        self.response.headers["Content-Type"] = "image/png"
+        self.response.out.write(content)
+
     def get(self, m, z, x, y):
         year = self.request.get('year', '')
-        key = "%s-tile-%s-%s-%s-%s" % (m, z, x, y, year)
-        cached_image = memcache.get(key)
-
-        if cached_image is None:
-          # logging.info('MEMCACHE MISS %s' % key)
-          entry = TileEntry.get_by_id(key)
-          if entry:
-            # logging.info('DATASTORE HIT %s' % key)
-            cached_image = entry.value
-            memcache.set(key, cached_image, 90000)
-          else:
-            # logging.info('DATASTORE MISS %s' % key)
-            pass
-        else:
-          # logging.info('MEMCAHCE HIT %s' % key)
-          pass
-
+        key = tile_key(m, z, x, y, year)
+        cached = get_cached_tile(m, z, x, y, year)
 
-        if cached_image is None:
+        if cached is None:
           mapid = MapInit(m.lower(), self.request).mapid
           if mapid is None:
             # TODO add better error code control
             self.error(503)
             return
           else:
-            retry_count = 0
-            max_retries = 5
-            n = 1
-            url="https://earthengine.googleapis.com/map/%s/%s/%s/%s?token=%s" % (mapid['mapid'], z, x, y, mapid['token'])
-
-            while retry_count < max_retries:
-              try:
-                result = urlfetch.fetch(url, deadline=60)
-                break
-              except:
-                logging.info('TILE RETRY %s' % url)
-                retry_count += 1
-                time.sleep(math.pow(2, n - 1))
-                n += 1
-          if not result or retry_count == max_retries:
+            url = tile_url(mapid, z, x, y)
+            result = fetch_tiles([url], m.lower())[0]
+          if result and result.status_code in (401, 403):
+            # The map id token expired, so replace it and try once more.
+            mapid = MapInit(m.lower(), self.request, stale=mapid).mapid
+            result = mapid and fetch_tiles([tile_url(mapid, z, x, y)],
+                                           m.lower())[0]
+          if not result:
             self.error(503)
+            self.response.headers['Retry-After'] = str(breaker.reset_timeout)
             return
 
           if result.status_code == 200:
-            memcache.set(key,result.content,90000)
-            TileEntry(id=key, value=result.content).put()
-            self.response.headers["Content-Type"] = "image/png"
-            self.response.headers.add_header("Expires", "Thu, 01 Dec 1994 16:00:00 GMT")
-            self.response.out.write(result.content)
+            self._send_tile(m, *cache_tile(key, result.content))
           elif result.status_code == 404:
-            # hhh!!!
-            self.redirect('http://downloads2.esri.com/support/TechArticles/blank256.png')
-            return
+            self._send_tile(m, *cache_tile(key, BLANK_TILE))
           else:
             self.response.set_status(result.status_code)
         else:
           # logging.info('CACHE HIT %s' % key)
-          self.response.headers["Content-Type"] = "image/png"
-          self.response.headers.add_header("Expires", "Thu, 01 Dec 1994 16:00:00 GMT")
-          self.response.out.write(cached_image)
+          self._send_tile(m, *cached)
+
+
+class RefreshMapId(webapp2.RequestHandler):
+    def post(self):
+      if not self.request.headers.get('X-AppEngine-QueueName'):
+        self.error(403)
+        return
+      reqid = self.request.get('layer')
+      key, args = _mapid_key(reqid, self.request)
+      cached = _load_mapid(key)
+      if not refresh_mapid(reqid, args, key, cached and cached[0]):
+        # Fail so the task queue retries.
+        self.error(503)
 
 
 class KeysGFW(webapp2.RequestHandler):
@@ -242,6 +620,7 @@ class KeysGFW(webapp2.RequestHandler):
 
 api = webapp2.WSGIApplication([ 
     ('/', MainPage), 
+    (MAPID_REFRESH_ROUTE, RefreshMapId),
     ('/gee/([^/]+)/([^/]+)/([^/]+)/([^/]+).png', TilesGFW), 
     ('/gee/([^/]+)', KeysGFW)
 
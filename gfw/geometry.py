@@ -0,0 +1,372 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports canonicalizing GeoJSON geometries.
+
+Equivalent polygons drawn by users rarely serialize the same way, so cache
+keys are built from a canonical form: coordinates are quantized, duplicate
+vertices dropped, rings rotated to start at their smallest vertex, exterior
+rings wound counterclockwise and holes clockwise.
+
+It also simplifies geometries before they are sent to CartoDB or Earth
+Engine, with a tolerance tied to the resolution of the dataset queried.
+"""
+
+import json
+import logging
+from hashlib import md5
+
+# Decimal places kept when quantizing coordinates (~0.1 m at the equator).
+PRECISION = 6
+
+# Meters per degree of latitude.
+METERS_PER_DEGREE = 111320.0
+
+
+def _is_position(coords):
+    """Return True if coords is a position rather than an array of them."""
+    return bool(coords) and not isinstance(coords[0], (list, tuple))
+
+
+def _quantize(coords, precision):
+    """Return coords with every coordinate coerced to a float and rounded.
+
+    Raises:
+      ValueError: if a coordinate isn't a number or numeric string.
+      TypeError: if coords isn't nested arrays of coordinates.
+    """
+    if not isinstance(coords, (list, tuple)):
+        raise TypeError('Expected coordinate array, got %r' % (coords,))
+    if _is_position(coords):
+        return [round(float(x), precision) for x in coords]
+    return [_quantize(x, precision) for x in coords]
+
+
+def _signed_area(ring):
+    """Return twice the signed area of a closed ring, positive if CCW."""
+    return sum(x0 * y1 - x1 * y0
+               for (x0, y0), (x1, y1) in zip(ring, ring[1:]))
+
+
+def _perpendicular_distance(point, start, end):
+    (x, y), (x0, y0), (x1, y1) = point[:2], start[:2], end[:2]
+    dx, dy = x1 - x0, y1 - y0
+    if dx == 0 and dy == 0:
+        return ((x - x0) ** 2 + (y - y0) ** 2) ** 0.5
+    return abs(dy * x - dx * y + x1 * y0 - y1 * x0) / (dx ** 2 + dy ** 2) ** 0.5
+
+
+def simplify_line(points, tolerance):
+    """Return points simplified with Douglas-Peucker for tolerance."""
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        index, dmax = None, tolerance
+        for i in xrange(first + 1, last):
+            d = _perpendicular_distance(points[i], points[first], points[last])
+            if d > dmax:
+                index, dmax = i, d
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def simplify_ring(ring, tolerance):
+    """Return closed ring simplified for tolerance, or the ring unchanged if
+    simplifying would collapse it."""
+    if len(ring) < 5:
+        return ring
+    # Split at the farthest vertex so both halves have fixed endpoints.
+    far = max(xrange(len(ring) - 1),
+              key=lambda i: _perpendicular_distance(ring[i], ring[0], ring[0]))
+    result = simplify_line(ring[:far + 1], tolerance)[:-1] + \
+        simplify_line(ring[far:], tolerance)
+    if len(result) < 4:
+        return ring
+    return result
+
+
+def _canonical_ring(ring, exterior):
+    points = []
+    for point in ring:
+        if not points or point != points[-1]:
+            points.append(point)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    if len(points) < 3:
+        return ring
+    closed = points + points[:1]
+    if (_signed_area(closed) > 0) != exterior:
+        points.reverse()
+    start = points.index(min(points))
+    points = points[start:] + points[:start]
+    return points + points[:1]
+
+
+def _canonical_polygon(rings, tolerance):
+    if tolerance:
+        rings = [simplify_ring(ring, tolerance) for ring in rings]
+    rings = [_canonical_ring(ring, i == 0) for i, ring in enumerate(rings)]
+    return rings[:1] + sorted(rings[1:])
+
+
+def _map_geometries(fn, geom):
+    """Return copy of geom with fn(kind, coordinates) applied to each
+    geometry it contains."""
+    if not isinstance(geom, dict):
+        return geom
+    kind = geom.get('type')
+    if kind == 'Feature':
+        return dict(geom, geometry=_map_geometries(fn, geom.get('geometry')))
+    if kind == 'FeatureCollection':
+        return dict(geom, features=[
+            _map_geometries(fn, x) for x in geom.get('features', [])])
+    if kind == 'GeometryCollection':
+        return dict(geom, geometries=[
+            _map_geometries(fn, x) for x in geom.get('geometries', [])])
+    if 'coordinates' not in geom:
+        return geom
+    return dict(geom, coordinates=fn(kind, geom['coordinates']))
+
+
+def canonical(geom, precision=PRECISION, tolerance=None):
+    """Return canonical copy of supplied GeoJSON geometry dictionary.
+
+    Args:
+      geom: GeoJSON geometry, Feature or FeatureCollection dictionary.
+      precision: Decimal places kept for coordinates.
+      tolerance: Optional Douglas-Peucker tolerance, in coordinate units,
+        applied to polygon rings before canonicalizing.
+    """
+    def canonicalize(kind, coords):
+        coords = _quantize(coords, precision)
+        if kind == 'Polygon':
+            return _canonical_polygon(coords, tolerance)
+        if kind == 'MultiPolygon':
+            return sorted(_canonical_polygon(x, tolerance) for x in coords)
+        return coords
+    return _map_geometries(canonicalize, geom)
+
+
+def _orientation(a, b, c):
+    v = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (v > 0) - (v < 0)
+
+
+def _on_segment(a, b, p):
+    return min(a[0], b[0]) <= p[0] <= max(a[0], b[0]) and \
+        min(a[1], b[1]) <= p[1] <= max(a[1], b[1])
+
+
+def _intersects(a, b, c, d):
+    """Return True if segments ab and cd share any point."""
+    o1, o2 = _orientation(a, b, c), _orientation(a, b, d)
+    o3, o4 = _orientation(c, d, a), _orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return (o1 == 0 and _on_segment(a, b, c)) or \
+        (o2 == 0 and _on_segment(a, b, d)) or \
+        (o3 == 0 and _on_segment(c, d, a)) or \
+        (o4 == 0 and _on_segment(c, d, b))
+
+
+def _crosses(rings):
+    """Return True if any ring crosses itself or another ring.
+
+    Segments are bucketed in a grid of about one segment per cell, so only
+    nearby segments are compared. Consecutive segments of a ring share a
+    vertex and aren't compared.
+    """
+    segments = []
+    for r, ring in enumerate(rings):
+        n = len(ring) - 1
+        for i in xrange(n):
+            segments.append((r, i, n, ring[i][:2], ring[i + 1][:2]))
+    if len(segments) < 2:
+        return False
+    xs = [p[0] for _, _, _, a, b in segments for p in (a, b)]
+    ys = [p[1] for _, _, _, a, b in segments for p in (a, b)]
+    x0, y0 = min(xs), min(ys)
+    size = max(max(xs) - x0, max(ys) - y0) / len(segments) ** 0.5 or 1.0
+    grid = {}
+    for k, (r, i, n, a, b) in enumerate(segments):
+        checked = set()
+        for cx in xrange(int((min(a[0], b[0]) - x0) / size),
+                         int((max(a[0], b[0]) - x0) / size) + 1):
+            for cy in xrange(int((min(a[1], b[1]) - y0) / size),
+                             int((max(a[1], b[1]) - y0) / size) + 1):
+                cell = grid.setdefault((cx, cy), [])
+                for j in cell:
+                    if j in checked:
+                        continue
+                    checked.add(j)
+                    r2, i2, _, c, d = segments[j]
+                    if r == r2 and (abs(i - i2) in (1, n - 1)):
+                        continue
+                    if _intersects(a, b, c, d):
+                        return True
+                cell.append(k)
+    return False
+
+
+def _contains(ring, point):
+    """Return True if point is inside closed ring, by ray casting."""
+    x, y = point[:2]
+    inside = False
+    for (x0, y0), (x1, y1) in zip([p[:2] for p in ring],
+                                  [p[:2] for p in ring[1:]]):
+        if (y0 > y) != (y1 > y) and \
+                x < (x1 - x0) * (y - y0) / float(y1 - y0) + x0:
+            inside = not inside
+    return inside
+
+
+def _valid(polygons):
+    """Return True if no rings of polygons cross and every hole starts
+    inside its exterior ring."""
+    for polygon in polygons:
+        for hole in polygon[1:]:
+            if not _contains(polygon[0], hole[0]):
+                return False
+    return not _crosses([ring for polygon in polygons for ring in polygon])
+
+
+def _simplify_polygons(polygons, tolerance):
+    """Return polygons with simplified rings, or unchanged if simplifying
+    ring by ring made rings cross or moved holes out of their polygon, which
+    CartoDB and Earth Engine reject."""
+    simplified = [[simplify_ring(ring, tolerance) for ring in polygon]
+                  for polygon in polygons]
+    if simplified == polygons:
+        return polygons
+    try:
+        if _valid(simplified):
+            return simplified
+    except (TypeError, IndexError, ZeroDivisionError):
+        pass
+    logging.info('SIMPLIFY kept original geom, simplified rings cross')
+    return polygons
+
+
+def _simplify_coords(tolerance):
+    def simplify(kind, coords):
+        if kind == 'Polygon':
+            return _simplify_polygons([coords], tolerance)[0]
+        if kind == 'MultiPolygon':
+            return _simplify_polygons(coords, tolerance)
+        if kind == 'LineString':
+            return simplify_line(coords, tolerance)
+        return coords
+    return simplify
+
+
+def count_vertices(geom):
+    """Return number of vertices in supplied geometry."""
+    counts = []
+
+    def count(kind, coords):
+        def points(x):
+            if not isinstance(x, (list, tuple)):
+                return 0
+            if _is_position(x):
+                return 1
+            return sum(points(y) for y in x)
+        counts.append(points(coords))
+        return coords
+    _map_geometries(count, geom)
+    return sum(counts)
+
+
+def simplify(geom, tolerance):
+    """Return copy of geometry with polygon rings and lines simplified by
+    Douglas-Peucker for tolerance in degrees.
+
+    Polygons whose simplified rings would cross are left unsimplified, so
+    the result is valid whenever the input is.
+    """
+    return _map_geometries(_simplify_coords(tolerance), geom)
+
+
+def simplify_params(params, resolution, name):
+    """Simplify params geom in place for a dataset with supplied resolution.
+
+    The tolerance is half the resolution, converted to degrees of latitude,
+    so the error stays below what the dataset can resolve.
+
+    Args:
+      params: Request params, left alone if they have no geom.
+      resolution: Dataset resolution in meters.
+      name: Dataset name used when logging vertex counts.
+    """
+    if not params.get('geom'):
+        return params
+    tolerance = resolution / 2.0 / METERS_PER_DEGREE
+    try:
+        geom = _load(params['geom'])
+        # Coerce string coordinates so simplification can do arithmetic.
+        geom = _map_geometries(lambda kind, coords: _quantize(coords, 15),
+                               geom)
+        simplified = simplify(geom, tolerance)
+    except Exception, e:
+        logging.info('SIMPLIFY %s geom skipped (%s: %s)' %
+                     (name, e.__class__.__name__, e))
+        return params
+    before, after = count_vertices(geom), count_vertices(simplified)
+    logging.info('SIMPLIFY %s geom from %s to %s vertices (%sm)' %
+                 (name, before, after, resolution))
+    if after < before:
+        if isinstance(params['geom'], basestring):
+            simplified = json.dumps(simplified)
+        params['geom'] = simplified
+    return params
+
+
+def _load(geom):
+    """Return geometry dictionary for supplied dictionary or JSON text."""
+    if isinstance(geom, basestring):
+        return json.loads(geom)
+    return geom
+
+
+def canonical_json(geom, precision=PRECISION, tolerance=None):
+    """Return compact canonical JSON text for supplied geometry."""
+    return json.dumps(canonical(_load(geom), precision, tolerance),
+                      sort_keys=True, separators=(',', ':'))
+
+
+def geom_hash(geom):
+    """Return hex digest identifying supplied geometry's canonical form."""
+    return md5(canonical_json(geom)).hexdigest()
+
+
+def normalize_params(params):
+    """Return copy of request params with geom replaced by its canonical JSON
+    text, for use when building cache keys."""
+    if not params.get('geom'):
+        return params
+    try:
+        geom = canonical_json(params['geom'])
+    except Exception:
+        # Malformed geoms are keyed by their raw text, as before.
+        return params
+    return dict(params, geom=geom)
@@ -19,6 +19,10 @@
 
 import json
 from gfw import cdb
+from gfw import geometry
+
+# Imazon SAD resolution in meters.
+RESOLUTION = 250
 
 # Download entire layer:
 DOWNLOAD = """SELECT *
@@ -57,6 +61,7 @@ ANALYSIS_GEOM = """SELECT data_type disturbance, SUM(ST_Area(ST_Intersection(the
 
 
 def download(params):
+    geometry.simplify_params(params, RESOLUTION, 'Imazon')
     if 'geom' in params:
         query = DOWNLOAD_GEOM.format(**params)
     else:
@@ -65,6 +70,7 @@ def download(params):
 
 
 def analyze(params):
+    geometry.simplify_params(params, RESOLUTION, 'Imazon')
     if 'geom' in params:
         query = ANALYSIS_GEOM.format(**params)
     elif 'iso' in params:
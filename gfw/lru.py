@@ -0,0 +1,69 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports a bounded in-process LRU cache."""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Thread safe least recently used cache bounded by number of entries.
+
+    Entries live in instance memory, so each App Engine instance has its own
+    copy. Use it in front of memcache for small, hot values. If ttl is given,
+    entries expire that many seconds after they were set.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return value for supplied key or None if not cached."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        """Cache supplied value, evicting the least recently used entry."""
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,346 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports dispatching notification emails in digests.
+
+Rendered messages are added to the mail-digest pull queue tagged by
+recipient, and a mail-dispatch task is scheduled for the end of the current
+DIGEST_WINDOW. That task leases everything queued for its recipient and
+sends it as one digest, so a recipient with several alerts gets one email.
+Sent messages are recorded by task name before their tasks are deleted, so
+a retry after a failed delete drops them instead of sending them again.
+
+Messages go through a pluggable transport: App Engine mail, SMTP, or a sink
+that only logs, picked with the mail_transport runtime config. When the
+transport reports it is over quota, dispatching pauses for a backoff that
+doubles on each refusal and halves on each success.
+"""
+
+import hashlib
+import json
+import logging
+import smtplib
+import time
+import webapp2
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import jinja2
+
+from appengine_config import runtime_config
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+try:
+    from google.appengine.api import mail
+except ImportError:
+    mail = None
+
+try:
+    from google.appengine.runtime import apiproxy_errors
+    OverQuotaError = apiproxy_errors.OverQuotaError
+except ImportError:
+    OverQuotaError = None
+
+SENDER = 'noreply@gfw-apis.appspotmail.com'
+
+# Pull queue of rendered messages tagged by recipient.
+DIGEST_QUEUE = 'mail-digest'
+
+# Push queue and route of per recipient dispatch tasks.
+DISPATCH_QUEUE = 'mail-dispatch'
+DISPATCH_ROUTE = '/pubsub/dispatch'
+
+# Seconds messages to one recipient are collected into a digest.
+DIGEST_WINDOW = 60
+
+# Seconds after the end of a window its dispatch task runs.
+DISPATCH_DELAY = 5
+
+# Most messages combined into one digest email.
+MAX_DIGEST = 20
+
+# Seconds queued messages are leased while a digest is sent.
+LEASE_SECONDS = 60
+
+# Seconds dispatching pauses after the first and repeated quota refusals.
+BACKOFF_INITIAL = 30
+BACKOFF_MAX = 60 * 30
+
+# Memcache namespace of backoff state and per minute counters.
+NAMESPACE = 'mailer'
+
+# Minutes of counters reported by metrics().
+METRICS_MINUTES = 10
+
+DIGEST_SUBJECT = '%s new forest change alerts from Global Forest Watch'
+
+_templates = jinja2.Environment(autoescape=False)
+
+DIGEST_BODY = _templates.from_string(
+    u"{% for m in messages %}{{ m.body }}"
+    u"{% if not loop.last %}\n\n----------------------------------------"
+    u"\n\n{% endif %}{% endfor %}")
+
+DIGEST_HTML = _templates.from_string(
+    u"{% for m in messages %}{{ m.html }}"
+    u"{% if not loop.last %}\n<hr>\n{% endif %}{% endfor %}")
+
+
+class OverQuota(Exception):
+    """The transport refused to send more mail for now."""
+
+
+class SentMessage(ndb.Model):
+    """Marks a digest queue task sent, keyed by the task name."""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class AppEngineTransport(object):
+    """Sends with the App Engine mail API."""
+
+    def send(self, to, subject, body, html):
+        try:
+            mail.send_mail(sender=SENDER, to=to, subject=subject, body=body,
+                           html=html)
+        except Exception, e:
+            if OverQuotaError and isinstance(e, OverQuotaError):
+                raise OverQuota(str(e))
+            raise
+
+
+class SMTPTransport(object):
+    """Sends through an SMTP server, connecting for each message."""
+
+    # SMTP replies meaning try again later.
+    THROTTLE_CODES = (421, 450, 451, 452)
+
+    def __init__(self, host, port=587, user=None, password=None, tls=True):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.tls = tls
+
+    def send(self, to, subject, body, html):
+        message = MIMEMultipart('alternative')
+        message['Subject'] = subject
+        message['From'] = SENDER
+        message['To'] = to
+        message.attach(MIMEText(body.encode('utf-8'), 'plain', 'utf-8'))
+        message.attach(MIMEText(html.encode('utf-8'), 'html', 'utf-8'))
+        try:
+            server = smtplib.SMTP(self.host, self.port)
+            try:
+                if self.tls:
+                    server.starttls()
+                if self.user:
+                    server.login(self.user, self.password)
+                server.sendmail(SENDER, [to], message.as_string())
+            finally:
+                server.quit()
+        except smtplib.SMTPResponseException, e:
+            if e.smtp_code in self.THROTTLE_CODES:
+                raise OverQuota('%s %s' % (e.smtp_code, e.smtp_error))
+            raise
+
+
+class SinkTransport(object):
+    """Keeps and logs messages instead of sending them, for local runs."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, to, subject, body, html):
+        self.messages.append(dict(to=to, subject=subject, body=body,
+                                  html=html))
+        logging.info('MAIL SINK %s: %s' % (to, subject))
+
+
+def _default_transport():
+    name = runtime_config.get('mail_transport')
+    if name == 'sink' or (name is None and mail is None):
+        return SinkTransport()
+    if name == 'smtp':
+        return SMTPTransport(
+            runtime_config['smtp_host'],
+            int(runtime_config.get('smtp_port', 587)),
+            runtime_config.get('smtp_user'),
+            runtime_config.get('smtp_password'))
+    return AppEngineTransport()
+
+
+transport = _default_transport()
+
+# Functions called with the refs of each delivered digest's messages.
+_listeners = []
+
+
+def on_delivered(listener):
+    """Register listener(refs) to call after messages are sent, with the
+    refs they were enqueued with. Usable as a decorator."""
+    _listeners.append(listener)
+    return listener
+
+
+def _minute(now=None):
+    return int((now or time.time()) // 60)
+
+
+def _count(name, n=1):
+    memcache.incr('%s:%s' % (name, _minute()), n, namespace=NAMESPACE,
+                  initial_value=0)
+
+
+def paused_until():
+    """Return time dispatching is paused until, or 0."""
+    return memcache.get('paused-until', namespace=NAMESPACE) or 0
+
+
+def _throttled():
+    backoff = memcache.get('backoff', namespace=NAMESPACE) or 0
+    backoff = min(max(backoff * 2, BACKOFF_INITIAL), BACKOFF_MAX)
+    memcache.set_multi({'backoff': backoff,
+                        'paused-until': time.time() + backoff},
+                       namespace=NAMESPACE)
+    _count('throttled')
+    logging.warning('MAIL OVER QUOTA, pausing %ss' % backoff)
+
+
+def _succeeded():
+    backoff = memcache.get('backoff', namespace=NAMESPACE)
+    if backoff:
+        backoff //= 2
+        memcache.set('backoff', backoff if backoff >= BACKOFF_INITIAL else 0,
+                     namespace=NAMESPACE)
+
+
+def enqueue(to, subject, body, html, ref=None):
+    """Queue a rendered message for the next digest to supplied recipient.
+
+    Args:
+      ref: JSON serializable value passed to on_delivered listeners once
+        the message is sent.
+    """
+    to = to.strip().lower()
+    payload = json.dumps(dict(subject=subject, body=body, html=html, ref=ref))
+    taskqueue.Queue(DIGEST_QUEUE).add(
+        taskqueue.Task(payload=payload, method='PULL', tag=to))
+    now = time.time()
+    window = int(now // DIGEST_WINDOW)
+    name = 'dispatch-%s-%s' % (
+        hashlib.md5(to.encode('utf-8')).hexdigest(), window)
+    countdown = (window + 1) * DIGEST_WINDOW - now + DISPATCH_DELAY
+    try:
+        taskqueue.add(url=DISPATCH_ROUTE, queue_name=DISPATCH_QUEUE,
+                      name=name, countdown=countdown, params=dict(to=to))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # This window's dispatch is already scheduled.
+        pass
+
+
+def digest(messages):
+    """Return (subject, body, html) combining supplied messages."""
+    if len(messages) == 1:
+        m = messages[0]
+        return m['subject'], m['body'], m['html']
+    return (DIGEST_SUBJECT % len(messages),
+            DIGEST_BODY.render(messages=messages),
+            DIGEST_HTML.render(messages=messages))
+
+
+def dispatch(to):
+    """Send everything queued for recipient as digests and return the
+    number of messages sent.
+
+    Raises:
+      OverQuota: if dispatching is paused or the transport refused.
+    """
+    if paused_until() > time.time():
+        raise OverQuota('Paused')
+    queue = taskqueue.Queue(DIGEST_QUEUE)
+    sent = 0
+    while True:
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, MAX_DIGEST, tag=to)
+        if not tasks:
+            return sent
+        markers = ndb.get_multi([ndb.Key(SentMessage, t.name) for t in tasks])
+        done = [t for t, m in zip(tasks, markers) if m]
+        if done:
+            # Sent by an earlier attempt whose delete failed.
+            queue.delete_tasks(done)
+            tasks = [t for t, m in zip(tasks, markers) if not m]
+            if not tasks:
+                continue
+        messages = [json.loads(t.payload) for t in tasks]
+        try:
+            transport.send(to, *digest(messages))
+        except Exception, e:
+            # Release the leases so this task's retry sends them again.
+            for task in tasks:
+                queue.modify_task_lease(task, 0)
+            if isinstance(e, OverQuota):
+                _throttled()
+            else:
+                _count('failed', len(messages))
+            raise
+        ndb.put_multi([SentMessage(id=t.name) for t in tasks])
+        queue.delete_tasks(tasks)
+        _succeeded()
+        _count('sent', len(messages))
+        _count('emails')
+        sent += len(messages)
+        refs = [m['ref'] for m in messages if m.get('ref') is not None]
+        for listener in _listeners:
+            try:
+                listener(refs)
+            except Exception, e:
+                logging.exception('MAIL listener failed (%s)' % e)
+
+
+def metrics():
+    """Return per minute counters and rates over the last minutes."""
+    now = _minute()
+    minutes = range(now - METRICS_MINUTES, now)
+    names = ['sent', 'emails', 'failed', 'throttled']
+    keys = ['%s:%s' % (name, m) for name in names for m in minutes]
+    counts = memcache.get_multi(keys, namespace=NAMESPACE)
+    totals = dict((name, sum(counts.get('%s:%s' % (name, m), 0)
+                             for m in minutes)) for name in names)
+    seconds = 60.0 * METRICS_MINUTES
+    return dict(
+        totals,
+        minutes=METRICS_MINUTES,
+        sent_per_second=round(totals['sent'] / seconds, 2),
+        emails_per_second=round(totals['emails'] / seconds, 2),
+        backoff=memcache.get('backoff', namespace=NAMESPACE) or 0,
+        paused_for=max(0, int(paused_until() - time.time())),
+        transport=transport.__class__.__name__)
+
+
+class Dispatcher(webapp2.RequestHandler):
+    def post(self):
+        """Sends the digest for one recipient, run from mail-dispatch."""
+        if not self.request.headers.get('X-AppEngine-QueueName'):
+            self.error(403)
+            return
+        try:
+            dispatch(self.request.get('to'))
+        except OverQuota:
+            # Fail so the queue retries after its backoff.
+            self.error(503)
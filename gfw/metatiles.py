@@ -0,0 +1,135 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports storing GEE tiles packed into metatiles on GCS.
+
+A metatile holds the SIZE x SIZE block of PNG tiles starting at
+(mx * SIZE, my * SIZE) in one GCS object, so a seeded pyramid is a few
+thousand objects instead of millions of datastore entities. The object
+starts with a fixed size header:
+
+  magic 'GFWM', size, z, mx, my         5 x 4 bytes
+  (offset, length) for each tile        SIZE * SIZE x 8 bytes, row major
+
+followed by the tile PNGs. Identical tiles share one copy and a zero length
+marks a missing tile. Headers are kept in memcache and a tile is served
+with a single ranged read.
+"""
+
+import logging
+import struct
+
+from cloudstorage import errors
+from gfw import gcs
+from gfw import tiles
+from google.appengine.api import memcache
+
+# Tiles per metatile side.
+SIZE = 8
+
+MAGIC = 'GFWM'
+
+_HEADER = struct.Struct('<4sIIII')
+_ENTRY = struct.Struct('<II')
+
+HEADER_SIZE = _HEADER.size + _ENTRY.size * SIZE * SIZE
+
+# Seconds memcache remembers a metatile doesn't exist.
+MISSING_TTL = 60 * 60
+
+# Seconds memcache keeps metatile indexes.
+INDEX_TTL = 60 * 60 * 24
+
+
+def path(layer, year, z, mx, my):
+    """Return GCS path of supplied metatile."""
+    return '%s/%s/%s/%s/%s/%s.meta' % (
+        gcs.TILE_BUCKET, layer.lower(), year or 'all', z, mx, my)
+
+
+def locate(x, y):
+    """Return (mx, my, i) of the metatile holding tile x, y and its index."""
+    return x // SIZE, y // SIZE, (y % SIZE) * SIZE + x % SIZE
+
+
+def pack(z, mx, my, contents):
+    """Return metatile bytes for {(x, y): png} tiles of block mx, my."""
+    entries, body, offsets = [], [], {}
+    offset = HEADER_SIZE
+    for i in range(SIZE * SIZE):
+        x, y = mx * SIZE + i % SIZE, my * SIZE + i // SIZE
+        content = contents.get((x, y)) or ''
+        if content and content not in offsets:
+            offsets[content] = offset
+            body.append(content)
+            offset += len(content)
+        entries.append(_ENTRY.pack(offsets.get(content, 0), len(content)))
+    header = _HEADER.pack(MAGIC, SIZE, z, mx, my)
+    return ''.join([header] + entries + body)
+
+
+def unpack_index(header):
+    """Return [(offset, length)] for each tile in a metatile header."""
+    magic, size, z, mx, my = _HEADER.unpack_from(header)
+    if magic != MAGIC or size != SIZE:
+        raise ValueError('Not a %sx%s metatile' % (SIZE, SIZE))
+    return [_ENTRY.unpack_from(header, _HEADER.size + _ENTRY.size * i)
+            for i in range(SIZE * SIZE)]
+
+
+def write(layer, year, z, mx, my, contents):
+    """Store {(x, y): png} tiles as metatile mx, my of layer at zoom z."""
+    value = pack(z, mx, my, contents)
+    name = path(layer, year, z, mx, my)
+    gcs.write_file(name, value, 'application/octet-stream')
+    memcache.set(name, unpack_index(value), INDEX_TTL)
+    logging.info('METATILE %s (%s tiles, %s bytes)' %
+                 (name, len(contents), len(value)))
+
+
+def get_index(layer, year, z, mx, my):
+    """Return [(offset, length)] of supplied metatile or None if missing."""
+    name = path(layer, year, z, mx, my)
+    index = memcache.get(name)
+    if index is None:
+        try:
+            index = unpack_index(gcs.read_range(name, 0, HEADER_SIZE))
+        except errors.NotFoundError:
+            index = []
+        memcache.set(name, index, INDEX_TTL if index else MISSING_TTL)
+    return index or None
+
+
+def exists(layer, year, z, mx, my):
+    return get_index(layer, year, z, mx, my) is not None
+
+
+def read(layer, year, z, x, y):
+    """Return PNG content of tile x, y at zoom z or None if not stored."""
+    mx, my, i = locate(x, y)
+    index = get_index(layer, year, z, mx, my)
+    if not index:
+        return None
+    offset, length = index[i]
+    if not length:
+        return None
+    return gcs.read_range(path(layer, year, z, mx, my), offset, length)
+
+
+def block(z, mx, my):
+    """Return (z, x, y) tiles stored in metatile mx, my at zoom z."""
+    return tiles.metatile(z, mx, my, SIZE)
@@ -19,6 +19,10 @@
 
 import json
 from gfw import cdb
+from gfw import geometry
+
+# MODIS resolution in meters.
+RESOLUTION = 250
 
 ANALYSIS = """SELECT count(*) AS total {select_geom}
 FROM modis_forest_change_copy m, world_countries c
@@ -35,6 +39,7 @@ GROUP BY c.the_geom"""
 
 
 def download(params):
+    geometry.simplify_params(params, RESOLUTION, 'MODIS')
     params['select_geom'] = ', c.the_geom'
     geom = params.get('geom')
     if geom:
@@ -45,6 +50,7 @@ def download(params):
 
 
 def analyze(params):
+    geometry.simplify_params(params, RESOLUTION, 'MODIS')
     params['select_geom'] = ''
     if 'iso' in params:
         params['iso'] = params['iso'].upper()
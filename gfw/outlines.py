@@ -0,0 +1,117 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports precomputed country outlines for map thumbnails.
+
+Each country's convex hull is simplified until its Google encoded polyline
+fits in a static map URL, then stored once in a CountryOutline keyed by
+ISO. A refresh computes every country in a single CartoDB query, after
+which building thumbnails makes no geometry queries.
+"""
+
+import json
+import logging
+
+from gfw import cdb
+from gfw import geometry
+from gfw import polyline
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+OUTLINES = """SELECT iso3 AS iso,
+  ST_AsGeoJSON(ST_ConvexHull(the_geom), 5) AS hull
+  FROM world_countries{where}"""
+
+# Longest encoded polyline kept, leaving room for the rest of a static map
+# URL under its 2048 character limit.
+MAX_POLYLINE = 1500
+
+# Douglas-Peucker tolerance, in degrees, first tried when a polyline is too
+# long. It doubles until the polyline fits, at most MAX_SIMPLIFY times.
+TOLERANCE = 0.01
+MAX_SIMPLIFY = 16
+
+# Memcache namespace of encoded polylines by ISO.
+NAMESPACE = 'outlines'
+
+# Cached for ISOs with no outline, and seconds it is kept.
+MISSING = ''
+MISSING_TTL = 60 * 60 * 24
+
+
+class CountryOutline(ndb.Model):
+    """Encoded polyline of a country's simplified outline, keyed by ISO."""
+    polyline = ndb.TextProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+def encode(hull):
+    """Return encoded polyline for GeoJSON polygon text, simplified to fit
+    MAX_POLYLINE characters within MAX_SIMPLIFY attempts."""
+    ring = json.loads(hull)['coordinates'][0]
+    encoded = polyline.encode_coords(ring)
+    tolerance = TOLERANCE
+    for _ in xrange(MAX_SIMPLIFY):
+        if len(encoded) <= MAX_POLYLINE or len(ring) <= 4:
+            break
+        simplified = geometry.simplify_ring(ring, tolerance)
+        if len(simplified) < len(ring):
+            ring = simplified
+            encoded = polyline.encode_coords(ring)
+        tolerance *= 2
+    return encoded
+
+
+def refresh(iso=None):
+    """Recompute and store outlines for iso, or all countries if None, and
+    return {iso: polyline}."""
+    where = " WHERE iso3 = upper('%s')" % iso if iso else ''
+    query = OUTLINES.format(where=where)
+    response = cdb.execute(query)
+    if response.status_code != 200:
+        raise Exception('CartoDB Failed (status=%s, content=%s, q=%s)' %
+                        (response.status_code, response.content, query))
+    outlines = {}
+    for row in json.loads(response.content)['rows']:
+        if row['iso'] and row['hull']:
+            try:
+                outlines[row['iso'].upper()] = encode(row['hull'])
+            except (ValueError, KeyError, IndexError, TypeError):
+                logging.info('OUTLINE skipped %s' % row['iso'])
+    ndb.put_multi([CountryOutline(id=k, polyline=v)
+                   for k, v in outlines.iteritems()])
+    memcache.set_multi(outlines, namespace=NAMESPACE)
+    logging.info('OUTLINES refreshed %s countries' % len(outlines))
+    return outlines
+
+
+def get(iso):
+    """Return encoded outline polyline for iso, computing it if missing, or
+    None if the country is unknown."""
+    iso = iso.upper()
+    value = memcache.get(iso, namespace=NAMESPACE)
+    if value is None:
+        entity = CountryOutline.get_by_id(iso)
+        if entity:
+            value = entity.polyline
+            memcache.set(iso, value, namespace=NAMESPACE)
+        else:
+            value = refresh(iso).get(iso)
+            if value is None:
+                # Unknown ISOs aren't queried again until MISSING expires.
+                memcache.set(iso, MISSING, MISSING_TTL, namespace=NAMESPACE)
+    return value or None
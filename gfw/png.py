@@ -0,0 +1,87 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports generating blank PNG tiles and detecting them."""
+
+import struct
+import zlib
+
+SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# PNGs larger than this aren't decoded when checking for blank tiles.
+BLANK_MAX_BYTES = 4096
+
+# Bytes per pixel by PNG color type, for 8 bit images.
+_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def blank(width=256, height=256):
+    """Return a fully transparent RGBA PNG of supplied size."""
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    rows = ('\x00' + '\x00' * width * 4) * height
+    return SIGNATURE + _chunk('IHDR', header) + \
+        _chunk('IDAT', zlib.compress(rows, 9)) + _chunk('IEND', '')
+
+
+def _chunks(content):
+    offset = len(SIGNATURE)
+    while offset + 8 <= len(content):
+        length, kind = struct.unpack_from('>I4s', content, offset)
+        yield kind, content[offset + 8:offset + 8 + length]
+        offset += 12 + length
+
+
+def is_transparent(content):
+    """Return True if content is a small 8 bit PNG whose pixel bytes are all
+    zero with an alpha channel or transparent palette entry 0, i.e. a blank
+    tile.
+
+    Every PNG row filter predicts zero from zero bytes, so an image is all
+    zeros exactly when its filtered scanlines are.
+    """
+    if len(content) > BLANK_MAX_BYTES or not content.startswith(SIGNATURE):
+        return False
+    header, data, trns = None, [], None
+    try:
+        for kind, value in _chunks(content):
+            if kind == 'IHDR':
+                header = struct.unpack('>IIBBBBB', value)
+            elif kind == 'IDAT':
+                data.append(value)
+            elif kind == 'tRNS':
+                trns = value
+        width, height, depth, color, _, _, interlace = header
+        if depth != 8 or interlace or color not in _CHANNELS:
+            return False
+        if color in (0, 2):
+            return False
+        if color == 3 and not (trns and trns[0] == '\x00'):
+            # Palette entry 0 isn't transparent.
+            return False
+        rows = zlib.decompress(''.join(data))
+    except (TypeError, ValueError, struct.error, zlib.error):
+        return False
+    stride = 1 + width * _CHANNELS[color]
+    if len(rows) != stride * height:
+        return False
+    return not any(rows[i * stride + 1:(i + 1) * stride].strip('\x00')
+                   for i in xrange(height))
@@ -17,18 +17,121 @@
 
 """This module supports pubsub."""
 
+import datetime
 import json
+import logging
+import time
+import jinja2
 import webapp2
 import monitor
 from gfw import polyline
 from gfw import forma
-from gfw import cdb
+from gfw import geometry
+from gfw import lru
+from gfw import mailer
+from gfw import outlines
 from appengine_config import runtime_config
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.api import mail
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext.webapp.mail_handlers import InboundMailHandler
 
+# Subscriptions handled per publish task before chaining the next one.
+PUBLISH_BATCH_SIZE = 500
+
+# Memcache namespace and seconds for alert summaries by event and AOI.
+ALERT_NAMESPACE = 'pubsub-alerts'
+ALERT_TTL = 60 * 60 * 24
+
+# Alert summary queries a publish task runs on CartoDB at once.
+ALERT_CONCURRENCY = 10
+
+# Memcache namespace of per event sent/failed counters and timings.
+PROGRESS_NAMESPACE = 'pubsub-progress'
+
+# Upper bounds, in milliseconds, of the notification timing histogram.
+TIMING_BUCKETS = [250, 500, 1000, 2500, 5000, 10000, 30000]
+
+STATIC_MAP_URL = u"http://maps.googleapis.com/maps/api/staticmap?sensor=false&size=600x400&path=fillcolor:0xAA000033|color:0xFFFFFF00|enc:%s"
+
+# AOI descriptions and map tags kept per instance, by aoi_key.
+AOI_CACHE_SIZE = 1024
+
+_templates = jinja2.Environment(autoescape=False)
+
+NOTIFY_BODY = _templates.from_string(u"""You have subscribed to forest change alerts through Global Forest Watch. This message reports new forest change alerts for one of your areas of interest (a country or self-drawn polygon).
+
+A total of {{ value }} {{ name }} {{ unit }} were detected within your area of interest in the past {{ interval }}. Explore the details of this dataset on Global Forest Watch <a href="http://globalforestwatch.com/sources#forest_change">here</a>. 
+
+Your area of interest is {{ aoi }}, as shown in the map below:
+
+{{ aoi_vis }}
+
+You can unsubscribe or manage your subscriptions by emailing: gfw@wri.org 
+
+You will receive a separate e-mail for each distinct polygon, country, or shape on the GFW map. You will also receive a separate e-mail for each dataset for which you have requested alerts (FORMA alerts, Imazon SAD Alerts, and NASA QUICC alerts.)
+
+Please note that this information is subject to the Global Forest Watch <a href='http://globalforestwatch.com/terms'>Terms of Service</a>.
+""")
+
+NOTIFY_HTML = _templates.from_string(u"""You have subscribed to forest change alerts through Global Forest Watch. This message reports new forest change alerts for one of your areas of interest (a country or self-drawn polygon).
+<p>
+A total of {{ value }} {{ name }} {{ unit }} were detected within your area of interest in the past {{ interval }}. Explore the details of this dataset on Global Forest Watch <a href="http://globalforestwatch.com/sources#forest_change">here</a>. 
+<p>
+Your area of interest is {{ aoi }}, as shown in the map below:
+<p>
+{{ aoi_vis }}
+<p>
+You can unsubscribe or manage your subscriptions by emailing: gfw@wri.org 
+<p>
+You will receive a separate e-mail for each distinct polygon, country, or shape on the GFW map. You will also receive a separate e-mail for each dataset for which you have requested alerts (FORMA alerts, Imazon SAD Alerts, and NASA QUICC alerts.)
+<p>
+Please note that this information is subject to the Global Forest Watch <a href='http://globalforestwatch.com/terms'>Terms of Service</a>.
+""")
+
+_aois = lru.LRUCache(AOI_CACHE_SIZE)
+
+
+def _aoi(params):
+    """Return (description, map img tag) for the area of interest in
+    subscription params, building each AOI's fragments once per instance."""
+    key = aoi_key(params)
+    fragments = _aois.get(key) if key else None
+    if fragments is None:
+        if 'geom' in params:
+            aoi = 'a user drawn polygon'
+            coords = json.loads(params['geom'])['coordinates'][0][0]
+            coords = [[float(j) for j in i] for i in coords]
+            poly = polyline.encode_coords(coords)
+        else:
+            aoi = 'a country (%s)' % params['iso']
+            poly = outlines.get(params['iso'])
+            if poly is None:
+                raise Exception('No outline for country %s' % params['iso'])
+        fragments = (aoi, '<img src="%s">' % (STATIC_MAP_URL % poly))
+        if key:
+            _aois.set(key, fragments)
+    return fragments
+
+
+def aoi_key(params):
+    """Return cache key for the area of interest in subscription params, so
+    subscriptions to equivalent polygons share it.
+
+    Returns None for a malformed geom, so that subscription's AOI is
+    computed on its own and only its notification can fail."""
+    if params.get('geom'):
+        try:
+            return 'geom:%s' % geometry.geom_hash(params['geom'])
+        except Exception, e:
+            logging.info('AOI key skipped for malformed geom (%s: %s)' %
+                         (e.__class__.__name__, e))
+            return None
+    if params.get('iso'):
+        return 'iso:%s' % params['iso'].upper()
+
 
 class Subscription(ndb.Model):
     topic = ndb.StringProperty()
@@ -38,9 +141,11 @@ class Subscription(ndb.Model):
     created = ndb.DateTimeProperty(auto_now_add=True)
 
     @classmethod
-    def get_by_topic(cls, topic):
-        """Return all confirmed Subscription entities for supplied topic."""
-        return cls.query(cls.topic == topic, cls.confirmed == True).iter()
+    def page_by_topic(cls, topic, cursor=None, size=PUBLISH_BATCH_SIZE):
+        """Return (subscriptions, cursor, more) for a page of confirmed
+        subscriptions to topic."""
+        return cls.query(cls.topic == topic, cls.confirmed == True).fetch_page(
+            size, start_cursor=cursor)
 
     @classmethod
     def unsubscribe(cls, topic, email):
@@ -49,11 +154,97 @@ class Subscription(ndb.Model):
             x.key.delete()
 
 
+def _bucket(ms):
+    """Return label of the TIMING_BUCKETS bucket ms falls in."""
+    for bound in TIMING_BUCKETS:
+        if ms <= bound:
+            return 'le%s' % bound
+    return 'gt%s' % TIMING_BUCKETS[-1]
+
+
+def _count(event_id, outcome, seconds):
+    memcache.offset_multi(
+        {outcome: 1, _bucket(seconds * 1000): 1},
+        key_prefix='%s:' % event_id, namespace=PROGRESS_NAMESPACE,
+        initial_value=0)
+
+
 class Event(ndb.Model):
+    """A published event and the state of its fan-out.
+
+    Publish tasks work through subscription pages, each chaining the next
+    before handling its own, so pages finish out of order. Each handled
+    page records its own start cursor and the next page's, so resume can
+    re-enqueue exactly the pages that aren't done. The event is multicasted
+    once every page up to the last is done. Sent and failed notifications are counted in memcache,
+    since they are far too frequent to write here.
+    """
     topic = ndb.StringProperty()
     params = ndb.JsonProperty()
     multicasted = ndb.BooleanProperty(default=False)
     created = ndb.DateTimeProperty(auto_now_add=True)
+    cursor = ndb.StringProperty(indexed=False)  # Start of next page.
+    page = ndb.IntegerProperty(default=0, indexed=False)
+    pages_done = ndb.IntegerProperty(repeated=True, indexed=False)
+    pages = ndb.IntegerProperty(indexed=False)  # Known once last page runs.
+    cursors = ndb.JsonProperty(default={})  # {page: start cursor}
+    dry_run = ndb.BooleanProperty(default=False, indexed=False)
+    run = ndb.IntegerProperty(default=0, indexed=False)
+    subscriptions = ndb.IntegerProperty(default=0, indexed=False)
+    enqueued = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    @staticmethod
+    @ndb.transactional
+    def record_page(key, page, start, cursor, subscriptions, enqueued):
+        """Record a handled page once, with its start cursor and the cursor
+        of the next page or None if it was the last."""
+        e = key.get()
+        if page in e.pages_done:
+            return e
+        now = datetime.datetime.utcnow()
+        e.pages_done.append(page)
+        e.cursors = dict(e.cursors or {})
+        e.cursors[str(page)] = start or None
+        if cursor:
+            e.cursors[str(page + 1)] = cursor
+        e.subscriptions += subscriptions
+        e.enqueued += enqueued
+        e.started = e.started or now
+        if page + 1 > e.page:
+            e.page = page + 1
+            e.cursor = cursor
+        if cursor is None:
+            e.pages = page + 1
+        if e.pages and len(set(e.pages_done)) >= e.pages:
+            # Pages run concurrently, so the last one isn't the end.
+            e.multicasted = True
+            e.finished = now
+        e.put()
+        return e
+
+    def count(self, outcome, seconds):
+        """Count a sent or failed notification taking supplied seconds."""
+        _count(self.key.id(), outcome, seconds)
+
+    def progress(self):
+        """Return fan-out state, counters and throughput as a dictionary."""
+        labels = ['sent', 'failed'] + [_bucket(x) for x in TIMING_BUCKETS] + \
+            [_bucket(TIMING_BUCKETS[-1] + 1)]
+        counts = memcache.get_multi(labels, key_prefix='%s:' % self.key.id(),
+                                    namespace=PROGRESS_NAMESPACE)
+        end = self.finished or datetime.datetime.utcnow()
+        seconds = (end - self.started).total_seconds() if self.started else 0
+        return dict(
+            id=self.key.id(), topic=self.topic, created=str(self.created),
+            multicasted=self.multicasted, page=self.page,
+            pages=self.pages, pages_done=len(self.pages_done), run=self.run,
+            subscriptions=self.subscriptions, enqueued=self.enqueued,
+            sent=counts.get('sent', 0), failed=counts.get('failed', 0),
+            histogram=dict((x, counts.get(x, 0)) for x in labels[2:]),
+            enqueued_per_second=round(self.enqueued / seconds, 2)
+            if seconds else 0)
 
 
 class Notification(ndb.Model):
@@ -68,21 +259,39 @@ class Notification(ndb.Model):
         return cls.get_by_id('%s+%s' % (event.key.id(), subscription.key.id()))
 
     @classmethod
-    def create(cls, event, subscription):
+    def get_or_create_multi(cls, event, subscriptions, alerts=None):
+        """Return notifications of event for subscriptions, storing the
+        missing ones with one get_multi and one put_multi.
+
+        Args:
+          alerts: Alert summaries by aoi_key, stored in new notifications.
+        """
+        alerts = alerts or {}
+        keys = [ndb.Key(cls, '%s+%s' % (event.key.id(), s.key.id()))
+                for s in subscriptions]
+        notifications = ndb.get_multi(keys)
+        missing = [(i, cls.create(event, s, alerts.get(aoi_key(s.params))))
+                   for i, (n, s) in enumerate(zip(notifications, subscriptions))
+                   if not n]
+        ndb.put_multi([n for i, n in missing])
+        for i, n in missing:
+            notifications[i] = n
+        return notifications
+
+    @classmethod
+    def create(cls, event, subscription, alert=None):
         id = '%s+%s' % (event.key.id(), subscription.key.id())
-        return cls(
-            id=id,
-            topic=event.topic,
-            params=dict(event=event.params, subscription=subscription.params))
+        params = dict(event=event.params, subscription=subscription.params)
+        if alert is not None:
+            params['alert'] = alert
+        return cls(id=id, topic=event.topic, params=params)
 
 
 def publish(params, dry_run=True):
     topic = params['topic']
-    event_key = Event(topic=topic, params=params).put()
-    taskqueue.add(
-        url='/pubsub/publish',
-        queue_name='pubsub-publish',
-        params=dict(event=event_key.urlsafe(), dry_run=dry_run))
+    event = Event(topic=topic, params=params, dry_run=bool(dry_run))
+    event.put()
+    enqueue_publish(event, dry_run)
 
 
 def subscribe(params):
@@ -119,89 +328,59 @@ class Subscriber(InboundMailHandler):
 class Notifier(webapp2.RequestHandler):
 
     def _body(self, alert, n, e, s):
-        body = """You have subscribed to forest change alerts through Global Forest Watch. This message reports new forest change alerts for one of your areas of interest (a country or self-drawn polygon).
-
-A total of {value} {name} {unit} were detected within your area of interest in the past {interval}. Explore the details of this dataset on Global Forest Watch <a href="http://globalforestwatch.com/sources#forest_change">here</a>. 
-
-Your area of interest is {aoi}, as shown in the map below:
-
-{aoi-vis}
-
-You can unsubscribe or manage your subscriptions by emailing: gfw@wri.org 
-
-You will receive a separate e-mail for each distinct polygon, country, or shape on the GFW map. You will also receive a separate e-mail for each dataset for which you have requested alerts (FORMA alerts, Imazon SAD Alerts, and NASA QUICC alerts.)
-
-Please note that this information is subject to the Global Forest Watch <a href='http://globalforestwatch.com/terms'>Terms of Service</a>.
-"""
-
-        html = """You have subscribed to forest change alerts through Global Forest Watch. This message reports new forest change alerts for one of your areas of interest (a country or self-drawn polygon).
-<p>
-A total of {value} {name} {unit} were detected within your area of interest in the past {interval}. Explore the details of this dataset on Global Forest Watch <a href="http://globalforestwatch.com/sources#forest_change">here</a>. 
-<p>
-Your area of interest is {aoi}, as shown in the map below:
-<p>
-{aoi-vis}
-<p>
-You can unsubscribe or manage your subscriptions by emailing: gfw@wri.org 
-<p>
-You will receive a separate e-mail for each distinct polygon, country, or shape on the GFW map. You will also receive a separate e-mail for each dataset for which you have requested alerts (FORMA alerts, Imazon SAD Alerts, and NASA QUICC alerts.)
-<p>
-Please note that this information is subject to the Global Forest Watch <a href='http://globalforestwatch.com/terms'>Terms of Service</a>.
-"""
-
-        alert['interval'] = 'month'
-        if not alert['value']:
-            alert['value'] = 0
-        if 'geom' in s:
-            alert['aoi'] = 'a user drawn polygon'
-            coords = json.loads(s['geom'])['coordinates'][0][0]
-            coords = [[float(j) for j in i] for i in coords]
-            poly = polyline.encode_coords(coords)
-            url = u"http://maps.googleapis.com/maps/api/staticmap?sensor=false&size=600x400&path=fillcolor:0xAA000033|color:0xFFFFFF00|enc:%s" % poly
-            alert['aoi-vis'] = '<img src="%s">' % url
-        else:
-            alert['aoi'] = 'a country (%s)' % s['iso']
-            sql = "SELECT ST_AsGeoJSON(ST_ConvexHull(the_geom)) FROM world_countries where iso3 = upper('%s')" % s['iso']
-            response = cdb.execute(sql)
-            if response.status_code == 200:
-                result = json.loads(response.content)
-                coords = json.loads(result['rows'][0]['st_asgeojson'])['coordinates']
-                poly = polyline.encode_coords(coords[0])
-                url = "http://maps.googleapis.com/maps/api/staticmap?sensor=false&size=600x400&path=fillcolor:0xAA000033|color:0xFFFFFF00|enc:%s" % poly
-                alert['aoi-vis'] = '<img src="%s">' % url
-            else:
-                raise Exception('CartoDB Failed (status=%s, content=%s, \
-                                q=%s)' % (response.status_code,
-                                          response.content,
-                                          sql))
-        return body.format(**alert), html.format(**alert)
+        context = dict(alert, value=alert['value'] or 0, interval='month')
+        context['aoi'], context['aoi_vis'] = _aoi(s)
+        return NOTIFY_BODY.render(context), NOTIFY_HTML.render(context)
 
     def post(self):
         """"""
+        started = time.time()
+        n = ndb.Key(urlsafe=self.request.get('notification')).get()
+        if not n or n.sent:
+            return
+        event = Event.get_by_id(int(n.key.id().split('+')[0]))
         try:
-            n = ndb.Key(urlsafe=self.request.get('notification')).get()
             e = n.params['event']
             s = n.params['subscription']
-            response = forma.subsription(s)
-            if response.status_code == 200:
+            result = n.params.get('alert')
+            if result is None:
+                response = forma.subsription(dict(s))
+                if response.status_code != 200:
+                    raise Exception('CartoDB Failed (status=%s, content=%s)' %
+                                    (response.status_code, response.content))
                 result = json.loads(response.content)['rows'][0]
-                body, html = self._body(result, n, e, s)
-                mail.send_mail(
-                    sender='noreply@gfw-apis.appspotmail.com',
-                    to=s['email'],
-                    subject='New Forest Change Alerts from Global Forest Watch',
-                    body=body,
-                    html=html)
-            else:
-                raise Exception('CartoDB Failed (status=%s, content=%s)' %
-                               (response.status_code, response.content))
+            body, html = self._body(result, n, e, s)
+            # Marked sent and counted by _delivered once the mail goes out.
+            mailer.enqueue(
+                s['email'],
+                'New Forest Change Alerts from Global Forest Watch',
+                body, html,
+                ref=dict(notification=n.key.urlsafe(),
+                         seconds=time.time() - started))
         except Exception, e:
+            if event:
+                event.count('failed', time.time() - started)
             name = e.__class__.__name__
             msg = 'Error: Publish %s (%s)' % (json.dumps(s), name)
             monitor.log(self.request.url, msg, error=e,
                         headers=self.request.headers)
 
 
+@mailer.on_delivered
+def _delivered(refs):
+    """Mark notifications in delivered mail refs sent and count the ones
+    that weren't already."""
+    seconds = dict((ndb.Key(urlsafe=r['notification']), r.get('seconds', 0))
+                   for r in refs if r.get('notification'))
+    notifications = [n for n in ndb.get_multi(seconds.keys())
+                     if n and not n.sent]
+    for n in notifications:
+        n.sent = True
+    ndb.put_multi(notifications)
+    for n in notifications:
+        _count(n.key.id().split('+')[0], 'sent', seconds[n.key])
+
+
 class Confirmer(webapp2.RequestHandler):
     def get(self):
         urlsafe = self.request.get('token')
@@ -225,22 +404,147 @@ class Confirmer(webapp2.RequestHandler):
         self.response.write('Subscription confirmed!')
 
 
+def _alerts(event, subscriptions):
+    """Return {aoi_key: alert summary} for the distinct AOIs of supplied
+    subscriptions, computing each one once per event.
+
+    Summaries are shared through memcache with the event's other publish
+    tasks, and AOIs whose query fails are left for Notifier to compute.
+    """
+    aois = {}
+    for s in subscriptions:
+        key = aoi_key(s.params or {})
+        if key:
+            aois.setdefault(key, s.params)
+    prefix = '%s:' % event.key.id()
+    alerts = memcache.get_multi(aois.keys(), key_prefix=prefix,
+                                namespace=ALERT_NAMESPACE)
+    pending = [(k, p) for k, p in aois.iteritems() if k not in alerts]
+    computed = {}
+    for i in xrange(0, len(pending), ALERT_CONCURRENCY):
+        futures = []
+        for key, params in pending[i:i + ALERT_CONCURRENCY]:
+            try:
+                futures.append((key, forma.subsription_async(dict(params))))
+            except Exception, e:
+                logging.info('ALERT %s skipped (%s)' % (key, e))
+        for key, future in futures:
+            try:
+                response = future.get_result()
+            except Exception, e:
+                logging.info('ALERT %s failed (%s)' % (key, e))
+                continue
+            if response.status_code == 200:
+                computed[key] = json.loads(response.content)['rows'][0]
+            else:
+                logging.info('ALERT %s failed (status=%s)' %
+                             (key, response.status_code))
+    if computed:
+        memcache.set_multi(computed, key_prefix=prefix, time=ALERT_TTL,
+                           namespace=ALERT_NAMESPACE)
+    alerts.update(computed)
+    logging.info('ALERTS %s subscriptions, %s AOIs, %s computed' %
+                 (len(subscriptions), len(aois), len(computed)))
+    return alerts
+
+
+def _enqueue_notifications(notifications, dry_run):
+    """Add notify tasks in batches, named by notification so a retried
+    publish task doesn't notify twice, and return the number added."""
+    queue = taskqueue.Queue('pubsub-notify')
+    tasks = [taskqueue.Task(
+        url='/pubsub/notify',
+        name='notify-%s' % n.key.id().replace('+', '-'),
+        params=dict(notification=n.key.urlsafe(), dry_run=dry_run))
+        for n in notifications if not n.sent]
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # The other tasks in the batch are still added.
+            pass
+    return len([t for t in tasks if t.was_enqueued])
+
+
+def enqueue_publish(event, dry_run, cursor=None, page=0):
+    """Add the publish task for supplied page of event's subscriptions."""
+    try:
+        taskqueue.add(
+            url='/pubsub/publish',
+            queue_name='pubsub-publish',
+            name='publish-%s-%s-%s' % (event.key.id(), event.run, page),
+            params=dict(event=event.key.urlsafe(), dry_run=dry_run,
+                        cursor=cursor or '', page=page))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Named by run and page so a retried task doesn't fork the chain.
+        pass
+
+
+@ndb.transactional
+def _next_run(key):
+    event = key.get()
+    if not event.multicasted:
+        event.run += 1
+        event.put()
+    return event
+
+
+def missing_pages(event):
+    """Return [(page, start cursor)] of event's pages that aren't done and
+    whose start is known."""
+    cursors = event.cursors or {}
+    known = [int(p) for p in cursors] + [0]
+    last = event.pages or max(known) + 1
+    done = set(event.pages_done)
+    missing = []
+    for page in xrange(last):
+        if page in done:
+            continue
+        cursor = cursors.get(str(page))
+        if page and not cursor:
+            # Restarting without a cursor would re-walk from the first page.
+            logging.warning('PUBLISH %s page %s has no start cursor' %
+                            (event.key.id(), page))
+            continue
+        missing.append((page, cursor))
+    return missing
+
+
+def resume(event):
+    """Re-enqueue event's pages that aren't done, from their recorded start
+    cursors."""
+    event = _next_run(event.key)
+    if not event.multicasted:
+        for page, cursor in missing_pages(event):
+            enqueue_publish(event, event.dry_run, cursor, page)
+    return event
+
+
 class Publisher(webapp2.RequestHandler):
     def post(self):
-        """Publish notifications to all event subscribers."""
+        """Publish notifications to a page of event subscribers and chain a
+        task for the next page."""
         e = ndb.Key(urlsafe=self.request.get('event')).get()
         dry_run = self.request.get('dry_run', False)
-        if not e.multicasted:
-            for s in Subscription.get_by_topic(e.topic):
-                n = Notification.get(e, s)
-                if not n:
-                    n = Notification.create(e, s)
-                    n.put()
-                taskqueue.add(
-                    url='/pubsub/notify',
-                    queue_name='pubsub-notify',
-                    params=dict(notification=n.key.urlsafe(), dry_run=dry_run))
-        e.multicasted = True
-        e.put()
+        start = self.request.get('cursor')
+        page = int(self.request.get('page', 0))
+        if page in e.pages_done:
+            return
+        if page and not start:
+            logging.error('PUBLISH %s page %s has no cursor' % (e.key.id(), page))
+            return
+        cursor = Cursor(urlsafe=start) if start else None
+        subscriptions, cursor, more = Subscription.page_by_topic(
+            e.topic, cursor)
+        cursor = cursor.urlsafe() if more and cursor else None
+        if cursor:
+            # Chain first so the next page runs while this one is handled.
+            enqueue_publish(e, dry_run, cursor, page + 1)
+        notifications = Notification.get_or_create_multi(
+            e, subscriptions, _alerts(e, subscriptions))
+        enqueued = _enqueue_notifications(notifications, dry_run)
+        Event.record_page(e.key, page, start, cursor, len(subscriptions),
+                          enqueued)
 
 handlers = webapp2.WSGIApplication([Subscriber.mapping()], debug=True)
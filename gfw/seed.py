@@ -0,0 +1,265 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports seeding GEE tile pyramids into the tile cache.
+
+A SeedJob covers one layer over a bbox and zoom range. It is worked through
+metatile by metatile by a chain of tile-seed tasks, whose queue rate limits
+the load on Earth Engine. Each task records the job's position, counted in
+metatiles, so a stopped job picks up where it left off. Metatiles with
+tiles that failed to fetch are recorded on the job and seeded again when
+it is resumed. Tiles are written to GCS as metatiles rather than one
+TileEntry each.
+"""
+
+import json
+import logging
+import time
+
+from gfw import cdb
+from gfw import gee_tiles
+from gfw import metatiles
+from gfw import tiles
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+# Metatiles seeded per task; their tiles are fetched concurrently.
+BATCH_SIZE = 1
+
+# Task queue seeding batches run on.
+QUEUE = 'tile-seed'
+
+# Route running one seeding batch.
+RUN_ROUTE = '/admin/seed/run'
+
+BBOX = """SELECT ST_XMin(ext) AS west, ST_YMin(ext) AS south,
+  ST_XMax(ext) AS east, ST_YMax(ext) AS north
+  FROM (SELECT ST_Extent(the_geom) AS ext
+        FROM world_countries
+        WHERE iso3 = upper('{iso}')) AS alias"""
+
+
+class SeedJob(ndb.Model):
+    layer = ndb.StringProperty()
+    year = ndb.StringProperty(default='')
+    iso = ndb.StringProperty()
+    bbox = ndb.JsonProperty()  # [west, south, east, north]
+    zmin = ndb.IntegerProperty()
+    zmax = ndb.IntegerProperty()
+    total = ndb.IntegerProperty(default=0)
+    position = ndb.IntegerProperty(default=0)
+    fetched = ndb.IntegerProperty(default=0)
+    cached = ndb.IntegerProperty(default=0)
+    failed = ndb.IntegerProperty(default=0)
+    seconds = ndb.FloatProperty(default=0.0)
+    failed_blocks = ndb.JsonProperty(default=[])  # [[z, mx, my]] unwritten
+    retrying = ndb.JsonProperty(default=[])  # [[z, mx, my]] to seed again
+    done = ndb.BooleanProperty(default=False)
+    run = ndb.IntegerProperty(default=0)  # Bumped by resume.
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    def ranges(self):
+        """Return ranges of metatiles covering the job's bbox."""
+        return tiles.metatile_ranges(
+            tiles.tile_ranges(self.bbox, self.zmin, self.zmax),
+            metatiles.SIZE)
+
+    def progress(self):
+        """Return job progress and throughput as a dictionary."""
+        rate = self.fetched / self.seconds if self.seconds else 0
+        return dict(
+            id=self.key.id(), layer=self.layer, year=self.year,
+            iso=self.iso, bbox=self.bbox, zmin=self.zmin, zmax=self.zmax,
+            total=self.total, position=self.position, fetched=self.fetched,
+            cached=self.cached, failed=self.failed,
+            failed_blocks=len(self.failed_blocks),
+            retrying=len(self.retrying), done=self.done,
+            percent=round(100.0 * self.position / self.total, 2)
+            if self.total else 100.0,
+            tiles_per_second=round(rate, 2))
+
+
+def get_bbox(iso):
+    """Return [west, south, east, north] of supplied country."""
+    response = cdb.execute(BBOX.format(iso=iso))
+    row = json.loads(response.content)['rows'][0]
+    return [row['west'], row['south'], row['east'], row['north']]
+
+
+def _step(job):
+    """Return (position, retries left) identifying the job's next batch."""
+    return job.position, len(job.retrying)
+
+
+def enqueue(job):
+    """Add the task for job's next batch, named by job, run and step so a
+    retried task or a repeated resume doesn't start a second chain."""
+    position, retries = _step(job)
+    try:
+        taskqueue.add(
+            url=RUN_ROUTE, queue_name=QUEUE,
+            name='seed-%s-%s-%s-%s' % (job.key.id(), job.run, position,
+                                       retries),
+            params=dict(job=job.key.id(), position=position,
+                        retries=retries))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def start(layer, zmin, zmax, bbox=None, iso=None, year=''):
+    """Create a seeding job for layer and enqueue its first batch."""
+    if not bbox:
+        if not iso:
+            raise ValueError('Tile seeding expects bbox or iso')
+        bbox = get_bbox(iso)
+    job = SeedJob(layer=layer, year=year or '', iso=iso, bbox=bbox,
+                  zmin=zmin, zmax=zmax)
+    job.total = tiles.count(job.ranges())
+    job.put()
+    enqueue(job)
+    return job
+
+
+def _seed_metatile(job, z, mx, my):
+    """Write metatile mx, my of job's layer, reusing tiles already cached,
+    and return (fetched, cached, failed) tile counts."""
+    block = metatiles.block(z, mx, my)
+    if metatiles.exists(job.layer, job.year, z, mx, my):
+        return 0, len(block), 0
+    keys = [gee_tiles.tile_key(job.layer, z, x, y, job.year)
+            for _, x, y in block]
+    contents = {}
+    found = gee_tiles.get_cached_tiles(keys)
+    missing = []
+    for key, (_, x, y) in zip(keys, block):
+        if key in found:
+            contents[(x, y)] = found[key][1]
+        else:
+            missing.append((x, y))
+    cached = len(contents)
+    failed = 0
+    if missing:
+        mapid = gee_tiles.MapInit(job.layer, dict(year=job.year)).mapid
+        if mapid is None:
+            return 0, cached, len(missing)
+        urls = [gee_tiles.tile_url(mapid, z, x, y) for x, y in missing]
+        results = gee_tiles.fetch_tiles(urls, job.layer)
+        for tile, result in zip(missing, results):
+            if result and result.status_code == 200:
+                contents[tile] = gee_tiles.dedupe(result.content)
+            elif result and result.status_code == 404:
+                contents[tile] = gee_tiles.BLANK_TILE
+            else:
+                failed += 1
+    if failed:
+        # Leave the metatile unwritten; run records it for resume to retry.
+        return len(contents) - cached, cached, failed
+    metatiles.write(job.layer, job.year, z, mx, my, contents)
+    return len(contents) - cached, cached, 0
+
+
+def _seed(job, batch):
+    """Seed supplied metatiles and return (fetched, cached, failed) tile
+    counts and the [z, mx, my] metatiles left unwritten."""
+    totals = [0, 0, 0]
+    unwritten = []
+    for z, mx, my in batch:
+        counts = _seed_metatile(job, z, mx, my)
+        for i, n in enumerate(counts):
+            totals[i] += n
+        if counts[2]:
+            unwritten.append([z, mx, my])
+    return tuple(totals) + (unwritten,)
+
+
+@ndb.transactional
+def _advance(job_id, step, size, fetched, cached, failed, unwritten,
+             seconds):
+    """Record a seeded batch if the job is still at step, and return the
+    job, or None if another chain already moved it on."""
+    job = SeedJob.get_by_id(job_id)
+    if not job or job.done or _step(job) != step:
+        return None
+    if job.retrying:
+        job.retrying = job.retrying[size:]
+    else:
+        job.position += size
+    job.failed_blocks = job.failed_blocks + unwritten
+    job.fetched += fetched
+    job.cached += cached
+    job.failed += failed
+    job.seconds += seconds
+    job.done = job.position >= job.total and not job.retrying
+    job.put()
+    return job
+
+
+def run(job_id, position=None, retries=None):
+    """Seed the next batch of supplied job and chain the following one.
+
+    Args:
+      position, retries: Step the task was enqueued for. A task whose step
+        the job has moved past is a duplicate and does nothing.
+    """
+    job = SeedJob.get_by_id(job_id)
+    if not job or job.done:
+        return job
+    step = _step(job)
+    if position is not None and (position, retries) != step:
+        return job
+    started = time.time()
+    if job.retrying:
+        batch = job.retrying[:BATCH_SIZE]
+    else:
+        batch = list(tiles.tiles(job.ranges(), job.position, BATCH_SIZE))
+    fetched, cached, failed, unwritten = _seed(job, batch)
+    advanced = _advance(job_id, step, len(batch), fetched, cached, failed,
+                        unwritten, time.time() - started)
+    if advanced is None:
+        logging.info('SEED %s step %s already done' % (job_id, step))
+        return job
+    logging.info('SEED %s' % json.dumps(advanced.progress()))
+    if not advanced.done:
+        enqueue(advanced)
+    return advanced
+
+
+@ndb.transactional
+def _restart(job_id):
+    job = SeedJob.get_by_id(job_id)
+    if job.done and job.failed_blocks:
+        job.retrying = job.failed_blocks
+        job.failed_blocks = []
+        job.done = False
+    if not job.done:
+        job.run += 1
+    job.put()
+    return job
+
+
+def resume(job):
+    """Re-enqueue a stopped job, or a done job's failed metatiles.
+
+    The new chain is named by a new run so it isn't blocked by the stopped
+    chain's task names. If the old chain is still running, both seed the
+    same batch once and whichever records it second stops.
+    """
+    job = _restart(job.key.id())
+    if not job.done:
+        enqueue(job)
+    return job
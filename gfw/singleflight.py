@@ -0,0 +1,123 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports coalescing identical in-flight requests.
+
+Within an instance, concurrent calls for the same key wait on the first call.
+Across instances, the first caller takes a memcache lease and the others poll
+the shared cache, backing off between polls, until the result lands or the
+lease goes away.
+"""
+
+import logging
+import threading
+import time
+import uuid
+
+from google.appengine.api import memcache
+
+# Memcache namespace for leases.
+NAMESPACE = 'singleflight'
+
+# Seconds a lease is held before other instances give up waiting.
+LEASE_TTL = 60
+
+# Seconds before the first poll while another instance holds the lease.
+POLL_INTERVAL = 0.25
+
+# Most seconds between polls, which double from POLL_INTERVAL.
+POLL_MAX_INTERVAL = 4
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run a function at most once at a time per key."""
+
+    def __init__(self, lease_ttl=LEASE_TTL, poll_interval=POLL_INTERVAL,
+                 poll_max_interval=POLL_MAX_INTERVAL):
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _wait_for_lease(self, key, lookup):
+        """Poll lookup while another instance holds the lease for key."""
+        deadline = time.time() + self.lease_ttl
+        interval = self.poll_interval
+        while time.time() < deadline:
+            value = lookup()
+            if value is not None:
+                return value
+            if memcache.get(key, namespace=NAMESPACE) is None:
+                return None
+            time.sleep(max(0, min(interval, deadline - time.time())))
+            interval = min(interval * 2, self.poll_max_interval)
+
+    def _run(self, key, fn, lookup):
+        token = uuid.uuid4().hex
+        if not memcache.add(key, token, time=self.lease_ttl,
+                            namespace=NAMESPACE):
+            logging.info('SINGLEFLIGHT WAIT %s' % key)
+            value = self._wait_for_lease(key, lookup)
+            if value is not None:
+                return value
+            value = lookup()
+            if value is not None:
+                return value
+        try:
+            return fn()
+        finally:
+            if memcache.get(key, namespace=NAMESPACE) == token:
+                memcache.delete(key, namespace=NAMESPACE)
+
+    def do(self, key, fn, lookup=lambda: None):
+        """Return fn() result, sharing it with concurrent callers of key.
+
+        Args:
+          key: Identifies the work, e.g. the request id.
+          fn: Computes the result and stores it where lookup can find it.
+          lookup: Returns the stored result or None, used to pick up results
+            computed by other instances.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            logging.info('SINGLEFLIGHT JOIN %s' % key)
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.value
+        try:
+            call.value = self._run(key, fn, lookup)
+            return call.value
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
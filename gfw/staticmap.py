@@ -9,6 +9,7 @@ from google.appengine.api import urlfetch
 import sys
 import os
 import io
+import hashlib
 import logging
 import urllib
 import urllib2
@@ -16,11 +17,11 @@ import webapp2
 import math
 import json
 
-from google.appengine.api import images
 from google.appengine.api import urlfetch
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
 
-import cache
+from gfw.compositor import Compositor
 
 if 'SERVER_SOFTWARE' in os.environ:
     PROD = not os.environ['SERVER_SOFTWARE'].startswith('Development')
@@ -29,6 +30,17 @@ else:
 
 maxzoom = 5
 
+
+class StaticMapEntry(ndb.Model):
+    """Composited map PNG keyed by its normalized parameters."""
+    value = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class StaticTileEntry(ndb.Model):
+    """Tile PNG keyed by the hash of its URL, shared by every map size."""
+    value = ndb.BlobProperty()
+
 class BaseHandler(webapp2.RequestHandler):
     def render_template(self, f, template_args):
         path = os.path.join(os.path.dirname(__file__), "templates", f)
@@ -43,15 +55,37 @@ class BaseHandler(webapp2.RequestHandler):
 # Create a species range map.
 #    params:
 #        name - a valid scientific name
+#        layer - optional layer name, species if missing
 #        size - width,height in pixels
-class StaticMap():
-    def get(self, iso, width, height):
-        self.iso = iso
-        self.width = width
-        self.height = height
-        self.size = [width, height]
+#        zoom - optional zoom level, picked to fit the bounds if missing
+#        bounds - optional xmin,ymin,xmax,ymax in web mercator meters
+class StaticMap(BaseHandler):
+    def get(self, iso=None, width=None, height=None):
+        if width is None or height is None:
+            width, height = self.request.get("size", "600,400").split(",")
+        self.iso = (iso or self.request.get("iso", "")).upper()
+        self.width = int(width)
+        self.height = int(height)
+        self.size = [self.width, self.height]
+        self.name = self.request.get("name", "").strip() or None
+        self.layer = self.request.get("layer", "").strip() or "species"
+        self.requestZoom = self.request.get("zoom", None)
+        bounds = self.request.get("bounds", None)
+        self.requestBounds = None
+        if bounds:
+            self.requestBounds = [
+                int(round(float(x))) for x in bounds.split(",")]
         if not self.probeCache():
             self.getStaticMap()
+
+    def cacheKey(self):
+        # Built from the parameters that change the image, so reordered
+        # query params or cache busters share one cached map.
+        params = json.dumps(dict(
+            layer=self.layer, name=self.name, iso=self.iso,
+            width=self.width, height=self.height, zoom=self.requestZoom,
+            bounds=self.requestBounds), sort_keys=True)
+        return "staticmap-%s" % hashlib.md5(params).hexdigest()
             
     def getStaticMap(self):
         # some constants, world dimensions in 
@@ -61,7 +95,7 @@ class StaticMap():
         xmin3857 = -20037508
         ymax3857 = 19971868
         #get bounds if none using extent from data
-        self.bounds = None
+        self.bounds = self.requestBounds
                 
         #get the desired map size in pixels
         
@@ -88,7 +122,6 @@ class StaticMap():
                     ST_Buffer(ST_Extent(the_geom_webmercator),20000) as geom 
                 FROM get_species_tile(\'%s\')
             ) tmp"""
-        self.name = self.request.get("name",None)
         self.tilesDone = 0
         
         
@@ -133,6 +166,8 @@ class StaticMap():
         maxzoom = min(math.floor(self.size[1]/5),math.floor(self.size[0]/5))
         
         self.zoom = min(zoom,maxzoom)            
+        if self.requestZoom:
+            self.zoom = int(self.requestZoom)
 
 
         logging.info('Zoom level is %i' % (self.zoom))
@@ -181,6 +216,7 @@ class StaticMap():
         self.image = None
         self.rpcs = []
         self.tiles = {'base': {}, 'map': {}}
+        self.compositor = Compositor()
             
         self.tileWidth = self.tileCoords[2]+1 - self.tileCoords[0]
         self.tileHeight = self.tileCoords[1]+1 - self.tileCoords[3] 
@@ -188,20 +224,21 @@ class StaticMap():
         self.pixHeight = self.tileHeight * 256
         self.pixWidth = self.tileWidth * 256
 
-        for tileY in range(self.tileCoords[3],self.tileCoords[1]+1):
-            Y = Y + 1
-            X = -1
-            for tileX in range(self.tileCoords[0],self.tileCoords[2]+1):
-                X = X + 1
-                logging.info(
-                     "appending tX: %i tY: %i X: %i Y: %i" % 
-                     (tileX, tileY, X, Y))
-                
-                self.createTileRPC(tileX,tileY,X,Y)
-        
-        
-        for rpc in self.rpcs:
-            rpc.wait()
+        with self.compositor.timer('fetch'):
+            for tileY in range(self.tileCoords[3],self.tileCoords[1]+1):
+                Y = Y + 1
+                X = -1
+                for tileX in range(self.tileCoords[0],self.tileCoords[2]+1):
+                    X = X + 1
+                    logging.info(
+                         "appending tX: %i tY: %i X: %i Y: %i" % 
+                         (tileX, tileY, X, Y))
+                    
+                    self.createTileRPC(tileX,tileY,X,Y)
+            
+            
+            for rpc in self.rpcs:
+                rpc.wait()
         
         
         self.cropComposite()        
@@ -210,18 +247,16 @@ class StaticMap():
 
             
     def cropComposite(self):
-        #crop to desired pixel size, centered on the bounds.
-        left_x = float(
-            (self.cX-self.size[0]/2-(self.tileCoords[0]*256))/self.pixWidth)
-        top_y = float(
-            (self.cY-self.size[1]/2-(self.tileCoords[3]*256))/self.pixHeight)
-        right_x = float(
-            1-(((self.tileCoords[2]+1)*256)-(self.cX+self.size[0]/2))/
-                self.pixWidth)
-        bottom_y = float(
-             1-(((self.tileCoords[1]+1)*256)-(self.cY+self.size[1]/2))/
-                self.pixHeight)
-        self.image = images.crop(self.image, left_x, top_y, right_x, bottom_y)
+        #composite all tiles in one pass, cropped to the desired pixel size
+        #centered on the bounds. Map tiles go over base tiles at 0.55.
+        for type, opacity, z in (('base', 1.0, 0), ('map', 0.55, 1)):
+            for X, column in self.tiles[type].iteritems():
+                for Y, content in column.iteritems():
+                    self.compositor.add(content, X*256, Y*256, opacity, z)
+        left = int(self.cX-self.size[0]/2-(self.tileCoords[0]*256))
+        top = int(self.cY-self.size[1]/2-(self.tileCoords[3]*256))
+        self.image = self.compositor.render(
+            left, top, int(self.size[0]), int(self.size[1]))
         
     def create_callback(self,rpc,url,type,X,Y):
         return lambda: self.handle_result(rpc,url,type,X,Y)
@@ -235,18 +270,24 @@ class StaticMap():
         self.createRPC(self.getBaseTileURL(tileX, tileY), 'base', X, Y)
         self.createRPC(self.getTileURL(tileX, tileY), 'map', X, Y) 
 
+    def tileKey(self, url):
+        # Tile URLs only depend on zoom, x, y and name, so maps of any size
+        # at the same zoom share tiles.
+        return "staticmap-tile-%s" % hashlib.md5(url).hexdigest()
+
     def createRPC(self, url, type, X, Y):
         
-        result = memcache.get(url)
+        key = self.tileKey(url)
+        result = memcache.get(key)
         if result:
             logging.info('Got %s %i %i from memcache' % (type, X, Y) )
             self.addResult(result, type, X, Y)
         else:
-            result = cache.get(url,value_type = 'blob')
-            if result:
+            entry = StaticTileEntry.get_by_id(key)
+            if entry:
                 logging.info('Got %s %i %i from datastore' % (type, X, Y) )
-                memcache.add(url,result)
-                self.addResult(result, type, X, Y)
+                memcache.add(key, entry.value)
+                self.addResult(entry.value, type, X, Y)
             else:
                 logging.info('Getting %s %i %i from %s' % (type, X, Y, url) )
                 rpc = urlfetch.create_rpc(deadline=240)
@@ -262,29 +303,33 @@ class StaticMap():
                logging.info('%s tile X:%i Y:%i made it' % (type, X, Y))
                self.addResult(result.content, type, X, Y)
                logging.info('caching url %s' % url)
-               memcache.add(url, result.content)
-               cache.add(url, result.content, value_type="blob")
+               key = self.tileKey(url)
+               memcache.add(key, result.content)
+               StaticTileEntry(id=key, value=result.content).put()
         
        except:
            logging.info('%s tile X:%i Y:%i failed' % (type, X, Y))
            self.tilesDone = self.tilesDone + 1
         
     def cacheImage(self):
-        memcache.add(self.request.url, self.image)
-        cache.add(self.request.url, self.image,value_type="blob")
+        key = self.cacheKey()
+        memcache.add(key, self.image)
+        StaticMapEntry(id=key, value=self.image).put()
     
     def probeCache(self):  
-        result = memcache.get(self.request.url)
+        key = self.cacheKey()
+        result = memcache.get(key)
         if result:
-            logging.info('Got %s from memcache' % (self.request.url) )
+            logging.info('Got %s from memcache' % (key) )
             self.image = result
             self.outputImage()
             return True
         else:
-            result = cache.get(self.request.url,value_type = 'blob')
-            if result:
-                logging.info('Got %s from datastore' % (self.request.url))      
-                self.image = result
+            entry = StaticMapEntry.get_by_id(key)
+            if entry:
+                logging.info('Got %s from datastore' % (key))      
+                self.image = entry.value
+                memcache.add(key, entry.value)
                 self.outputImage()
                 return True
             else:
@@ -299,33 +344,6 @@ class StaticMap():
         self.tiles[type][X][Y] = result
         
         self.tilesDone = self.tilesDone + 1
-        
-        if type == 'base':
-            if self.image == None:
-                self.image = result
-            logging.info('compositing base %i %i' % (X, Y))
-            self.image = images.composite(
-                 [(self.image,0,0,1.0,images.TOP_LEFT),
-                 (result, (X*256), (Y*256), 1.0, images.TOP_LEFT)],
-                 self.pixWidth, self.pixHeight)
-            if X in self.tiles['map']:
-                if Y in self.tiles['map'][X]:
-                    logging.info('compositing map %i %i' % (X, Y))
-                    self.image = images.composite(
-                     [(self.image,0,0,1.0,images.TOP_LEFT),
-                     (self.tiles['map'][X][Y], (X*256), (Y*256), 0.55, 
-                         images.TOP_LEFT)],
-                     self.pixWidth, self.pixHeight)
-            
-        if type == 'map':
-            if X in self.tiles['base']:
-                if Y in self.tiles['base'][X]:
-                    logging.info('compositing map %i %i' % (X, Y))
-                    self.image = images.composite(
-                     [(self.image,0,0,1.0,images.TOP_LEFT),
-                     (result, (X*256), (Y*256), 0.55, images.TOP_LEFT)],
-                     self.pixWidth, self.pixHeight)
-            
                 
         logging.info(
              '%i tiles done, %i tiles requested' % 
@@ -20,11 +20,15 @@
 import json
 from appengine_config import runtime_config
 from gfw import cdb
+from gfw import geometry
 import datetime
 
 
 TABLE = 'stories_dev' if runtime_config.get('IS_DEV') else 'community_stories'
 
+# Meters stories AOI filters are simplified to, stories being points.
+RESOLUTION = 100
+
 
 INSERT = """INSERT INTO {table}
   (details, email, featured, name, title, token, visible, date, location,
@@ -69,11 +73,13 @@ def create(params):
     props['geom'] = json.dumps(props['geom'])
     if 'media' in props:
         props['media'] = json.dumps(props['media'])
-    return cdb.execute(INSERT.format(**props), auth=True)
+    # Not retried: a timed out INSERT may have committed.
+    return cdb.execute(INSERT.format(**props), auth=True, retry=False)
 
 
 def list(params):
     and_where = ''
+    geometry.simplify_params(params, RESOLUTION, 'stories')
     if 'geom' in params:
         and_where = """AND ST_Intersects(the_geom::geography,
             ST_SetSRID(ST_GeomFromGeoJSON('{geom}'),4326)::geography)"""
@@ -0,0 +1,96 @@
+# Global Forest Watch API
+# Copyright (C) 2013 World Resource Institute
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""This module supports enumerating Google/OSM style XYZ map tiles.
+
+It has no App Engine dependencies so tools can use it too.
+"""
+
+import math
+
+# Latitude limit of the web mercator projection.
+MAX_LAT = 85.0511287798
+
+
+def tile_xy(lon, lat, z):
+    """Return (x, y) of the tile containing lon, lat at zoom z."""
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    rad = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(rad) + 1 / math.cos(rad)) / math.pi)
+            / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_ranges(bbox, zmin, zmax):
+    """Return (z, xmin, xmax, ymin, ymax) tile ranges covering bbox.
+
+    Args:
+      bbox: (west, south, east, north) in degrees.
+      zmin, zmax: Inclusive zoom range.
+    """
+    west, south, east, north = bbox
+    ranges = []
+    for z in range(zmin, zmax + 1):
+        xmin, ymin = tile_xy(west, north, z)
+        xmax, ymax = tile_xy(east, south, z)
+        ranges.append((z, xmin, xmax, ymin, ymax))
+    return ranges
+
+
+def count(ranges):
+    """Return number of tiles in supplied ranges."""
+    return sum((xmax - xmin + 1) * (ymax - ymin + 1)
+               for z, xmin, xmax, ymin, ymax in ranges)
+
+
+def tiles(ranges, start=0, limit=None):
+    """Generate (z, x, y) tiles in ranges, skipping the first start tiles.
+
+    Tiles are ordered by zoom, then y, then x, so a position in the sequence
+    is stable and can be used to resume.
+    """
+    emitted = 0
+    for z, xmin, xmax, ymin, ymax in ranges:
+        width = xmax - xmin + 1
+        size = width * (ymax - ymin + 1)
+        if start >= size:
+            start -= size
+            continue
+        for i in xrange(start, size):
+            if limit is not None and emitted >= limit:
+                return
+            yield z, xmin + i % width, ymin + i // width
+            emitted += 1
+        start = 0
+
+
+def metatile_ranges(ranges, size):
+    """Return (z, mxmin, mxmax, mymin, mymax) ranges of size x size blocks
+    of tiles covering supplied tile ranges."""
+    return [(z, xmin // size, xmax // size, ymin // size, ymax // size)
+            for z, xmin, xmax, ymin, ymax in ranges]
+
+
+def metatile(z, mx, my, size):
+    """Return (z, x, y) tiles in the size x size block mx, my at zoom z,
+    clipped to the world at low zooms."""
+    n = 2 ** z
+    return [(z, x, y)
+            for y in range(my * size, min((my + 1) * size, n))
+            for x in range(mx * size, min((mx + 1) * size, n))]
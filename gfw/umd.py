@@ -27,6 +27,7 @@ import config
 import copy
 
 from gfw import cdb
+from gfw import geometry
 
 SUM = """SELECT iso, sum(loss_gt_0) loss, avg(gain) gain
          FROM umd
@@ -56,6 +57,7 @@ def _get_range(result, begin, end):
 
 def _ee(urlparams, asset_id):
     params = copy.copy(urlparams)
+    geometry.simplify_params(params, int(params.get('scale') or 90), 'UMD')
     loss_by_year = ee.Image(config.assets[asset_id])
     poly = _get_coords(json.loads(params.get('geom')))
     params.pop('geom')
@@ -0,0 +1,118 @@
+"""Seeds GEE tiles by requesting them from the API, replacing cache.bash.
+
+Example:
+  python seed_tiles.py landsat_composites --year 2012 \
+    --bbox 143.5,-11,152,-1 --zmin 4 --zmax 8 --rate 20
+
+Progress is written to a state file after every batch so an interrupted run
+resumes where it stopped. Large seeds are better run server side through
+/admin/seed/start, which writes straight into the tile cache.
+"""
+
+import argparse
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from gfw import tiles
+
+API_URL = 'http://gfw-apis.appspot.com'
+
+# (api, layer, z, x, y)
+TILE_URL = '%s/gee/%s/%s/%s/%s.png'
+
+
+class RateLimiter(object):
+    """Allows at most rate calls per second across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def worker(queue, results, limiter, args):
+    session = requests.Session()
+    while True:
+        try:
+            z, x, y = queue.get(False)
+        except Queue.Empty:
+            return
+        limiter.wait()
+        url = TILE_URL % (args.api, args.layer, z, x, y)
+        params = dict(year=args.year) if args.year else {}
+        try:
+            response = session.get(url, params=params, timeout=60)
+            results.append(response.status_code == 200)
+        except Exception, e:
+            print 'ERROR: %s (%s)' % (url, e)
+            results.append(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed GEE tile cache.')
+    parser.add_argument('layer')
+    parser.add_argument('--bbox', required=True,
+                        help='west,south,east,north in degrees')
+    parser.add_argument('--zmin', type=int, required=True)
+    parser.add_argument('--zmax', type=int, required=True)
+    parser.add_argument('--year', default='')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='max tile requests per second')
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--api', default=API_URL)
+    parser.add_argument('--state', default='seed_tiles.json')
+    args = parser.parse_args()
+
+    ranges = tiles.tile_ranges(map(float, args.bbox.split(',')),
+                               args.zmin, args.zmax)
+    total = tiles.count(ranges)
+    position = 0
+    if os.path.exists(args.state):
+        state = json.load(open(args.state))
+        if state.get('args') == vars(args):
+            position = state['position']
+            print 'Resuming at tile %s of %s' % (position, total)
+
+    limiter = RateLimiter(args.rate)
+    started, done, failed = time.time(), 0, 0
+    while position < total:
+        queue, results = Queue.Queue(), []
+        for tile in tiles.tiles(ranges, position, args.batch):
+            queue.put(tile)
+        size = queue.qsize()
+        threads = [threading.Thread(target=worker,
+                                    args=(queue, results, limiter, args))
+                   for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        position += size
+        done += size
+        failed += results.count(False)
+        json.dump(dict(args=vars(args), position=position),
+                  open(args.state, 'w'))
+        elapsed = time.time() - started
+        print '%s/%s tiles (%.1f%%), %s failed, %.1f tiles/s' % \
+            (position, total, 100.0 * position / total, failed,
+             done / elapsed)
+
+
+if __name__ == '__main__':
+    main()